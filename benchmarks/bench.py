@@ -0,0 +1,219 @@
+#!/usr/bin/python
+'''Benchmarks for the I/O and render hot paths, on synthetic ROOT files
+   made here from a fixed seed. Each case is timed best of --repeats and the
+   results written as JSON. Given a --baseline from an earlier run, any case
+   more than --tolerance slower than it is reported and the exit status is 1
+
+    python benchmarks/bench.py --out baseline.json
+    python benchmarks/bench.py --baseline baseline.json --out latest.json
+'''
+from argparse import ArgumentParser
+import distutils.spawn
+import subprocess
+import tempfile
+import platform
+import shutil
+import json
+import time
+import sys
+import os
+import numpy as np
+from stencil.lazy import ROOT
+import stencil.rio as rio
+import stencil.plot as plt
+import stencil.parse as parse
+from stencil.paint import paintit
+
+# bins per axis for each dimension, so each histogram has a similar size
+bins_for_dim = {1 : 2000, 2 : 50, 3 : 12}
+
+def make_hist(name, dim, n_bins, rng):
+    '''A TH1D/TH2D/TH3D with n_bins per axis and random contents
+    '''
+    axes = (n_bins, 0., 1.) * dim
+    hist = getattr(ROOT, "TH{0}D".format(dim))(name, name, *axes)
+    hist.SetDirectory(0)
+    contents = rng.poisson(100., hist.GetSize()).astype(np.float64)
+    hist.SetContent(contents)
+    hist.SetEntries(contents.sum())
+    return hist
+
+def make_files(work_dir, n_files, n_keys, dim, n_bins, seed = 1234):
+    '''Write n_files files each holding the same n_keys histogram names
+    '''
+    rng = np.random.RandomState(seed)
+    filenames = []
+    for i in range(n_files):
+        filename = os.path.join(work_dir, "synth_{0}_{1}_{2}d_{3}.root".format(
+            n_files, n_keys, dim, i))
+        rt_f = ROOT.TFile(filename, "RECREATE")
+        for k in range(n_keys):
+            hist = make_hist("h{0}".format(k), dim, n_bins, rng)
+            rt_f.WriteTObject(hist)
+        rt_f.Close()
+        filenames.append(filename)
+    return filenames
+
+def best_of(repeats, setup, func):
+    '''Least wall time of func(setup()) over repeats, setup isn't timed
+    '''
+    times = []
+    for i in range(repeats):
+        args = setup()
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+def bench_startup(repeats):
+    '''Importing the stencil modules, which must not bring in ROOT
+    '''
+    code = ("import stencil.plot, stencil.paint, stencil.parse, stencil.jobs\n"
+            "from stencil.lazy import root_loaded\n"
+            "assert not root_loaded()")
+    return best_of(repeats, tuple,
+                   lambda: subprocess.check_call([sys.executable, "-c", code]))
+
+def bench_common_obs(repeats, filenames):
+    '''Reading every shared key from every file with a fresh session
+    '''
+    return best_of(repeats, lambda: (rio.RootSession(),),
+                   lambda session: rio.get_common_obs(filenames, session))
+
+def clones(hists):
+    '''Fresh copies to draw, drawing restyles them
+    '''
+    copies = [x.Clone() for x in hists]
+    for x in copies:
+        x.SetDirectory(0)
+    return copies
+
+def overlay_of(hists, options):
+    '''A PlotOverlay holding copies of hists
+    '''
+    po = plt.PlotOverlay(**options)
+    for i, hist in enumerate(clones(hists)):
+        po.add_obj(hist, "h{0}".format(i))
+    return po
+
+def bench_draw(repeats, hists, options):
+    '''PlotOverlay.draw on an overlay of hists
+    '''
+    return best_of(repeats, lambda: (overlay_of(hists, options),),
+                   lambda po: po.draw())
+
+def stack_of(hists, options):
+    '''A HistStack holding copies of hists
+    '''
+    hs = plt.HistStack(options)
+    for i, hist in enumerate(clones(hists)):
+        hs.add_hist(hist, "h{0}".format(i))
+    return hs
+
+def bench_stack(repeats, hists, options):
+    '''HistStack.build on hists
+    '''
+    return best_of(repeats, lambda: (stack_of(hists, options),),
+                   lambda hs: hs.build())
+
+def bench_paint(repeats, hists, options, outfile, pgf = False):
+    '''paintit on a drawn overlay of hists, png or pdf by outfile. pgf
+       writes PDFs with the pgfplots backend
+    '''
+    def setup():
+        cf1, cf2, replace_dict = parse.prepare_for_ext(dict(options), {},
+                                                      os.path.splitext(outfile)[1])
+        po = overlay_of(hists, cf1)
+        return po.draw(), replace_dict, po if pgf else None
+    return best_of(repeats, setup,
+                   lambda can, replace_dict, overlay: paintit(can, outfile, replace_dict,
+                                                               overlay = overlay))
+
+def run_all(work_dir, quick, repeats):
+    '''Every case, by name
+    '''
+    names, defaults, types = parse.read_args(plt.PlotOverlay.__init__)
+    options = dict(zip(names, defaults))
+    options["title"] = "$\\chi^{2}$"
+
+    file_counts = (2,) if quick else (2, 8, 40)
+    key_counts  = (10,) if quick else (10, 200)
+    n_overlay   = (2, 20) if quick else (2, 20, 200)
+
+    results = {"startup" : bench_startup(repeats)}
+    for dim, n_bins in sorted(bins_for_dim.items()):
+        if quick:
+            n_bins = max(n_bins // 10, 5)
+        for n_files in file_counts:
+            for n_keys in key_counts:
+                filenames = make_files(work_dir, n_files, n_keys, dim, n_bins)
+                results["common_obs/{0}d/{1}files/{2}keys".format(dim, n_files, n_keys)] = \
+                    bench_common_obs(repeats, filenames)
+
+        rng = np.random.RandomState(dim)
+        hists = [make_hist("o{0}".format(i), dim, n_bins, rng) for i in range(max(n_overlay))]
+        for n_obs in n_overlay:
+            results["draw/{0}d/{1}obs".format(dim, n_obs)] = \
+                bench_draw(repeats, hists[:n_obs], options)
+            if dim < 3:
+                results["draw_downsample/{0}d/{1}obs".format(dim, n_obs)] = \
+                    bench_draw(repeats, hists[:n_obs], dict(options, downsample = True))
+            if dim == 1:
+                results["stack_build/{0}hists".format(n_obs)] = \
+                    bench_stack(repeats, hists[:n_obs], options)
+
+        results["paint_png/{0}d".format(dim)] = bench_paint(
+            repeats, hists[:2], options, os.path.join(work_dir, "paint.png"))
+        if distutils.spawn.find_executable("pdflatex") is not None:
+            results["paint_pdf/{0}d".format(dim)] = bench_paint(
+                repeats, hists[:2], options, os.path.join(work_dir, "paint.pdf"))
+            results["paint_pgfplots/{0}d".format(dim)] = bench_paint(
+                repeats, hists[:2], options, os.path.join(work_dir, "paint.pdf"), True)
+    return results
+
+def regressions(results, baseline, tolerance):
+    '''Cases slower than the baseline by more than tolerance (a fraction)
+    '''
+    slower = []
+    for name, secs in sorted(results.items()):
+        base = baseline["results"].get(name)
+        if base is not None and secs > base * (1. + tolerance):
+            slower.append((name, base, secs))
+    return slower
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--out", type=str, default = "bench_results.json")
+    parser.add_argument("--baseline", type=str, default = "")
+    parser.add_argument("--tolerance", type=float, default = 0.2)
+    parser.add_argument("--repeats", type=int, default = 3)
+    parser.add_argument("--quick", action = "store_true")
+    parser.add_argument("--work_dir", type=str, default = "")
+    args = parser.parse_args()
+
+    ROOT.gROOT.SetBatch(True)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix = "stencil_bench")
+    try:
+        results = run_all(work_dir, args.quick, args.repeats)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors = True)
+
+    with open(args.out, "w") as f:
+        json.dump({"meta"    : {"python" : platform.python_version(),
+                                "root"   : ROOT.gROOT.GetVersion(),
+                                "host"   : platform.node(),
+                                "quick"  : args.quick,
+                                "time"   : time.strftime("%Y-%m-%d %H:%M:%S")},
+                   "results" : results}, f, indent = 1, sort_keys = True)
+
+    for name, secs in sorted(results.items()):
+        sys.stdout.write("{0:<40} {1:10.4f} s\n".format(name, secs))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for name, base, secs in slower:
+            sys.stdout.write("REGRESSION {0}: {1:.4f} s -> {2:.4f} s\n".format(name, base, secs))
+        if slower:
+            sys.exit(1)
@@ -5,5 +5,6 @@ setup(name = "stencil",
       description = "Plot Tools for PP theses",
       author = "Jack Dunger",
       packages = ["stencil"],
+      install_requires = ["numpy"],
       scripts = glob("bin/*")
 )
@@ -0,0 +1,59 @@
+'''Tools for spreading many plots over a pool of worker processes
+'''
+import multiprocessing
+import traceback
+import sys
+import stencil.rio as rio
+from stencil.timing import profiler
+from stencil.lazy import ROOT
+
+def init_worker():
+    '''Run ROOT in batch mode and give the worker its own file handles,
+       rather than the ones inherited from the parent
+    '''
+    ROOT.gROOT.SetBatch(True)
+    rio.default_session = rio.RootSession()
+
+def call_safely(func_and_item):
+    '''Call func on item, returning (result, None, timings) or (None, traceback 
+       as a string, timings) on failure. Exceptions from ROOT don't always 
+       pickle, strings do. timings are the profiler records made by the call
+    '''
+    func, item = func_and_item
+    mark = len(profiler.records)
+    try:
+        return func(item), None, profiler.take(mark)
+    except Exception:
+        return None, traceback.format_exc(), profiler.take(mark)
+
+def run_each(func, items, jobs = 1):
+    '''Call func on every item, in jobs worker processes if jobs > 1.
+       Returns the results (None where func failed) and (item, traceback) 
+       for every failure, both in the order of items whatever order the 
+       workers finish in
+    '''
+    tasks = [(func, x) for x in items]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker)
+        try:
+            outcomes = pool.map(call_safely, tasks, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outcomes = [call_safely(x) for x in tasks]
+    for res, err, timings in outcomes:
+        profiler.records.extend(timings)
+    results  = [res for res, err, timings in outcomes]
+    failures = [(x, err) for x, (res, err, timings) in zip(items, outcomes) 
+                if err is not None]
+    return results, failures
+
+def report_failures(failures, stream = sys.stderr):
+    '''Write out a summary of what failed, return True if anything did
+    '''
+    for item, err in failures:
+        stream.write("Failed on {0}:\n{1}\n".format(item, err))
+    if failures:
+        stream.write("{0} failure(s)\n".format(len(failures)))
+    return len(failures) > 0
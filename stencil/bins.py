@@ -0,0 +1,221 @@
+'''NumPy copies of histogram bins, so sums and extrema over a whole overlay
+   take a few array operations rather than a PyROOT call per object (or bin)
+'''
+from collections import OrderedDict
+import numpy as np
+
+dtypes = {"C" : np.int8, "S" : np.int16, "I" : np.int32,
+          "F" : np.float32, "D" : np.float64}
+
+# the value ROOT uses for "no maximum/minimum set"
+unset = -1111
+
+def buffer_to_array(buf, size, dtype):
+    '''Copy a C array handed back by PyROOT into numpy. The buffers don't
+       always know their own length, so tell them
+    '''
+    if hasattr(buf, "SetSize"):
+        buf.SetSize(size)
+    elif hasattr(buf, "reshape"):
+        buf.reshape((size,))
+    return np.frombuffer(buf, dtype = dtype, count = size).copy()
+
+def axis_edges(axis):
+    '''Bin edges of a TAxis, nbins + 1 of them
+    '''
+    edges = axis.GetXbins()
+    if edges.GetSize() > 0:
+        return buffer_to_array(edges.GetArray(), edges.GetSize(), np.float64)
+    return np.linspace(axis.GetXmin(), axis.GetXmax(), axis.GetNbins() + 1)
+
+def get_axes(hist):
+    '''All three axes, used or not
+    '''
+    return (hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis())
+
+class BinArrays(object):
+    '''Contents, errors and edges of one histogram. Contents and errors
+       include under/overflow and are indexed [z, y, x] as ROOT stores them
+    '''
+    def __init__(self, hist):
+        '''Read everything from the histogram in one go
+        '''
+        self.dim = hist.GetDimension()
+        axes = get_axes(hist)
+        self.shape = tuple(ax.GetNbins() + 2 for ax in reversed(axes[:self.dim]))
+        size = hist.GetSize()
+        try:
+            contents = buffer_to_array(hist.GetArray(), size,
+                                       dtypes[hist.ClassName()[-1]])
+        except (TypeError, ValueError):
+            contents = np.array([hist.GetBinContent(i) for i in xrange(size)])
+
+        if hist.GetSumw2N() > 0:
+            sumw2 = buffer_to_array(hist.GetSumw2().GetArray(), size, np.float64)
+        else:
+            sumw2 = np.abs(contents)
+        self.contents = contents.astype(np.float64).reshape(self.shape)
+        self.errors   = np.sqrt(sumw2).reshape(self.shape)
+        self.edges    = [axis_edges(ax) for ax in axes]
+
+    def scale(self, factor):
+        '''Keep in step with a TH1::Scale on the histogram
+        '''
+        self.contents *= factor
+        self.errors   *= abs(factor)
+
+def from_columns(dim, contents, errors, edges):
+    '''BinArrays from arrays already to hand (e.g. a snapshot) rather
+       than read from a histogram
+    '''
+    arrays = BinArrays.__new__(BinArrays)
+    arrays.dim      = dim
+    arrays.shape    = contents.shape
+    arrays.contents = contents
+    arrays.errors   = errors
+    arrays.edges    = list(edges)
+    return arrays
+
+def axis_window(axis):
+    '''The first and last bin in the user range of axis
+    '''
+    return axis.GetFirst(), axis.GetLast()
+
+def window(hist, dim):
+    '''Bin ranges currently shown for each axis of hist, z first to match
+       the array layout
+    '''
+    return tuple(axis_window(ax) for ax in reversed(get_axes(hist)[:dim]))
+
+def reduce_in_range(hists, arrays, reducer):
+    '''Apply reducer to the in-range contents of each histogram. Histograms
+       with the same shape and range are stacked and done in one call
+    '''
+    groups = OrderedDict()
+    for i, (hist, arr) in enumerate(zip(hists, arrays)):
+        groups.setdefault((arr.shape, window(hist, arr.dim)), []).append(i)
+
+    results = np.zeros(len(hists))
+    for (shape, win), idx in groups.items():
+        cut = tuple(slice(first, last + 1) for first, last in win)
+        stacked = np.stack([arrays[i].contents[cut] for i in idx]).reshape(len(idx), -1)
+        if stacked.shape[1] > 0:
+            results[idx] = reducer(stacked, axis = 1)
+    return results
+
+def integrals(hists, arrays):
+    '''TH1::Integral() for each histogram, i.e. summed over the user range
+    '''
+    return reduce_in_range(hists, arrays, np.sum)
+
+def maxima(hists, arrays):
+    '''TH1::GetMaximum() for each histogram, using a maximum set by hand
+       where there is one
+    '''
+    results = reduce_in_range(hists, arrays, np.max)
+    stored = np.array([x.GetMaximumStored() for x in hists], dtype = np.float64)
+    return np.where(stored != unset, stored, results)
+
+def extents(hists, arrays, axis_index):
+    '''Lowest low edge and highest high edge in the user range of the given
+       axis (0, 1, 2 for x, y, z) across the histograms, None if there are none
+    '''
+    if not hists:
+        return None
+    lows  = np.empty(len(hists))
+    highs = np.empty(len(hists))
+    for i, (hist, arr) in enumerate(zip(hists, arrays)):
+        first, last = axis_window(get_axes(hist)[axis_index])
+        edges = arr.edges[axis_index]
+        first = min(max(first, 1), len(edges) - 1)
+        last  = min(max(last, first), len(edges) - 1)
+        lows[i]  = edges[first - 1]
+        highs[i] = edges[last]
+    return lows.min(), highs.max()
+
+def merge_bins(values, factor, axis):
+    '''Sum runs of factor neighbouring bins along axis of values, the last
+       run may be shorter. Under/overflow are left as they are
+    '''
+    n_bins = values.shape[axis] - 2
+    inner  = np.take(values, np.arange(1, n_bins + 1), axis = axis)
+    merged = np.add.reduceat(inner, np.arange(0, n_bins, factor), axis = axis)
+    return np.concatenate([np.take(values, [0], axis = axis), merged,
+                           np.take(values, [n_bins + 1], axis = axis)], axis = axis)
+
+def scale_last_bin(values, axis, factor):
+    '''Scale the last bin (before overflow) along axis of values by factor
+    '''
+    index = [slice(None)] * values.ndim
+    index[axis] = values.shape[axis] - 2
+    values[tuple(index)] *= factor
+
+def downsample(arrays, limits):
+    '''Merge neighbouring bins, in place, until axis i has no more than
+       limits[i] bins. Contents are summed, and the outer edges are kept,
+       so the axis extents don't change. If the bins don't split evenly the
+       last run is shorter, so it's scaled up to the content per unit width
+       of the run before it, rather than showing a false drop at the upper
+       edge. Otherwise integrals don't change. Returns True if anything was
+       merged
+    '''
+    changed = False
+    for i, limit in enumerate(limits[:arrays.dim]):
+        n_bins = len(arrays.edges[i]) - 1
+        factor = -(-n_bins // limit)
+        if factor < 2:
+            continue
+        # arrays are [z, y, x]
+        axis = arrays.dim - 1 - i
+        arrays.contents = merge_bins(arrays.contents, factor, axis)
+        arrays.errors   = np.sqrt(merge_bins(arrays.errors ** 2, factor, axis))
+        arrays.edges[i] = np.append(arrays.edges[i][:-1:factor], arrays.edges[i][-1])
+        if n_bins % factor:
+            widths = np.diff(arrays.edges[i][-3:])
+            scale_last_bin(arrays.contents, axis, widths[0] / widths[1])
+            scale_last_bin(arrays.errors, axis, widths[0] / widths[1])
+        changed = True
+    arrays.shape = arrays.contents.shape
+    return changed
+
+def fill(hist, arrays):
+    '''Set the contents and errors of hist from arrays of the same binning
+    '''
+    hist.SetContent(np.ascontiguousarray(arrays.contents.ravel()))
+    hist.SetError(np.ascontiguousarray(arrays.errors.ravel()))
+
+def refill(hist, arrays):
+    '''Rebin hist, in place, to the edges in arrays and fill it with their
+       contents and errors
+    '''
+    entries = hist.GetEntries()
+    new_bins = []
+    for edges in arrays.edges[:arrays.dim]:
+        new_bins += [len(edges) - 1, edges]
+    hist.SetBins(*new_bins)
+    fill(hist, arrays)
+    hist.SetEntries(entries)
+
+def same_binning(first, second):
+    '''Do two BinArrays have the same dimension and bin edges?
+    '''
+    return (first.dim == second.dim and first.shape == second.shape and
+            all(np.array_equal(x, y) for x, y in zip(first.edges, second.edges)))
+
+def add(first, second):
+    '''Bin by bin sum of two BinArrays, errors in quadrature. Raises
+       ValueError if the binnings differ
+    '''
+    if not same_binning(first, second):
+        raise ValueError("can't add histograms with different binning")
+    return from_columns(first.dim, first.contents + second.contents,
+                        np.hypot(first.errors, second.errors), first.edges)
+
+def tree_sum(parts):
+    '''Sum a list of BinArrays pairwise, a level at a time
+    '''
+    parts = list(parts)
+    while len(parts) > 1:
+        pairs = [add(parts[i], parts[i + 1]) for i in range(0, len(parts) - 1, 2)]
+        parts = pairs + parts[len(pairs) * 2:]
+    return parts[0]
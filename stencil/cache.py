@@ -0,0 +1,121 @@
+'''An on disk cache of rendered plots, keyed on a hash of everything that goes
+   into drawing them, so unchanged plots are copied rather than redrawn
+'''
+import hashlib
+import json
+import shutil
+import os
+import stencil.rio as rio
+import stencil.bins as bins
+from stencil.lazy import ROOT
+
+# bytes held in each cache directory, kept up to date by the stores this
+# process makes so a store doesn't have to list the whole directory
+cache_sizes = {}
+
+def fingerprint(obj):
+    '''Hash the contents of a ROOT object. For histograms this is the bin
+       contents, errors and axes, anything else falls back to its JSON streaming
+    '''
+    md5 = hashlib.md5(obj.ClassName())
+    if rio.is_histogram(obj):
+        arrays = bins.BinArrays(obj)
+        md5.update(arrays.contents.tobytes())
+        md5.update(arrays.errors.tobytes())
+        for edges in arrays.edges:
+            md5.update(repr(len(edges)))
+            md5.update(edges.tobytes())
+    else:
+        md5.update(str(ROOT.TBufferJSON.ConvertToJSON(obj)))
+    return md5.hexdigest()
+
+def make_key(obs, options, replace_dict, extension):
+    '''Key for a plot made from the list of objects obs. options are the
+       PlotOverlay constructor options (and anything else that changes the
+       drawing, e.g. draw options and legend names), replace_dict the output
+       of parse.prepare_for_ext
+    '''
+    md5 = hashlib.md5(extension.lstrip("."))
+    for ob in obs:
+        md5.update(fingerprint(ob))
+    md5.update(json.dumps(options, sort_keys = True, default = repr))
+    md5.update(json.dumps(replace_dict, sort_keys = True))
+    return md5.hexdigest()
+
+class RenderCache(object):
+    '''Finished plots stored by key in cache_dir. Once the cache grows past
+       max_bytes, the least recently used entries are removed until it's
+       back under keep_fraction of that
+    '''
+    def __init__(self, cache_dir, max_bytes = 2 * 1024 ** 3, keep_fraction = 0.9):
+        '''Make the directory if needed
+        '''
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.keep_bytes = int(keep_fraction * max_bytes)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, key, outfile):
+        '''Where the entry for key is kept. The extension comes from the output
+        '''
+        return os.path.join(self.cache_dir, key + os.path.splitext(outfile)[1])
+
+    def fetch(self, key, outfile):
+        '''Copy the cached plot to outfile if we have one, returns True on a hit
+        '''
+        cached = self.path(key, outfile)
+        if not os.path.exists(cached):
+            return False
+        shutil.copyfile(cached, outfile)
+        # mark as recently used
+        os.utime(cached, None)
+        return True
+
+    def store(self, key, outfile):
+        '''Keep a copy of a freshly drawn outfile, trimming the cache if
+           that takes it past max_bytes. The directory is only listed the
+           first time, and when it needs trimming
+        '''
+        cached = self.path(key, outfile)
+        tmp_name = cached + ".tmp{0}".format(os.getpid())
+        shutil.copyfile(outfile, tmp_name)
+        os.rename(tmp_name, cached)
+        if self.cache_dir in cache_sizes:
+            cache_sizes[self.cache_dir] += os.path.getsize(cached)
+        else:
+            cache_sizes[self.cache_dir] = sum(x[1] for x in self.entries())
+        if cache_sizes[self.cache_dir] > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        '''(mtime, size, path) of every finished entry
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if ".tmp" in name:
+                # still being written
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # another process got there first
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        '''Remove least recently used entries until we're inside keep_bytes
+        '''
+        entries = self.entries()
+        total = sum(x[1] for x in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.keep_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        cache_sizes[self.cache_dir] = total
@@ -1,28 +1,42 @@
-'''Color schemes are just dictionaries matching names to ROOT colors. 
-   fetch one by name using get_color_scheme
+'''Color schemes are just dictionaries matching names to colors, kept as hex
+   strings (or ROOT color numbers) so importing this doesn't need ROOT. 
+   fetch one by name using get_color_scheme, which converts to ROOT colors
 '''
-import ROOT
-ROOT.PyConfig.IgnoreCommandLineOptions = True
+from stencil.lazy import ROOT
 import sys
 
 default = {
-    "uchain"     : ROOT.TColor.GetColor("#4b6ebc"),
-    "thchain"    : ROOT.TColor.GetColor("#669966"),
-    "cosmogenic" : ROOT.TColor.GetColor("#00cccc"),
-    "b8"         : ROOT.TColor.GetColor("#996633"),
-    "external"   : ROOT.TColor.GetColor("#ff9900"),
+    "uchain"     : "#4b6ebc",
+    "thchain"    : "#669966",
+    "cosmogenic" : "#00cccc",
+    "b8"         : "#996633",
+    "external"   : "#ff9900",
     "twonu"      : 15
 }
 
 
 '''Return a basic list of colors for ROOT plots. Default to these when no
-   color specified by name
+   color specified by name. These are ROOT's kRed, kBlue, kViolet, kOrange, 
+   kBlue, kBlack and kMagenta
 '''
-backup_list =  [ROOT.kRed, ROOT.kBlue, ROOT.kViolet, ROOT.kOrange, 
-               ROOT.kBlue, ROOT.kBlack, ROOT.kMagenta]
+backup_list =  [632, 600, 880, 800, 
+                600, 1, 616]
 
+# schemes already converted to ROOT colors, by name
+resolved = {}
+
+def to_root_color(col):
+    '''Hex strings are converted with TColor, anything else is taken to be a
+       ROOT color already
+    '''
+    if isinstance(col, str):
+        return ROOT.TColor.GetColor(col)
+    return col
 
 def get_color_scheme(name):
     '''Find a color scheme in this module by name
     '''
-    return getattr(sys.modules[__name__], name)
+    if name not in resolved:
+        scheme = getattr(sys.modules[__name__], name)
+        resolved[name] = dict((k, to_root_color(v)) for k, v in scheme.iteritems())
+    return resolved[name]
@@ -0,0 +1,216 @@
+'''Plot jobs: dictionaries saying what to draw from which files, e.g.
+
+    {"type"     : "stack",
+     "inputs"   : [{"filename" : "u.root", "objname" : "energy",
+                    "name" : "uchain", "leg_name" : "U chain"}, ...],
+     "options"  : {"color_scheme" : "default", "log_y" : true},
+     "outfile"  : "energy.pdf"}
+
+   "options" are the PlotOverlay constructor arguments ConstructorParser
+   builds, anything left out takes its usual default. Types are "single",
+   "overlay", "stack" and "shared" - every key the input files have in
+   common, written to <prefix><object name>.<ext>. Optional extras are
+   "draw_opt", "leg_opt", "stack" (stack an overlay), "prefix", "ext",
+   "cache_dir" and "backend" ("pgfplots" to write PDFs with pgfplots rather
+   than ROOT's tex output). The bin scripts, the render server and the batch runner all
+   draw through here
+'''
+import socket
+import json
+import sys
+import os
+import stencil.plot as plt
+import stencil.rio as rio
+import stencil.parse as parse
+import stencil.cache as cache
+import stencil.paint as paint
+from stencil.paint import paintit
+from stencil.timing import profiler
+
+def overlay_options(options):
+    '''Fill in the PlotOverlay defaults for anything options leaves out
+    '''
+    names, defaults, types = parse.read_args(plt.PlotOverlay.__init__)
+    full = dict(zip(names, defaults))
+    full.update(options)
+    return full
+
+def for_key(job, key):
+    '''The overlay (or stacked overlay) of key from each input of a shared job
+    '''
+    inputs = [dict(x, objname = key) for x in job["inputs"]]
+    return dict(job, type = "overlay", inputs = inputs)
+
+def expand(job, session = None):
+    '''Split a job into jobs that each make one plot
+    '''
+    if job["type"] != "shared":
+        return [job]
+    filenames = [x["filename"] for x in job["inputs"]]
+    return [for_key(job, key) for key in rio.get_common_keys(filenames, session)]
+
+def describe(job):
+    '''Short name for a plot in failure reports
+    '''
+    return job.get("outfile") or ",".join(str(x.get("objname")) for x in job["inputs"])
+
+def get_outfile(job, obs):
+    '''The output name, made from the first object's name if not given
+    '''
+    if job.get("outfile"):
+        return job["outfile"]
+    return "{0}{1}.{2}".format(job.get("prefix", ""), obs[0].GetName(),
+                               job.get("ext", "png"))
+
+def load(job, session = None):
+    '''Read the objects for each input
+    '''
+    return [rio.grab_obj(x["filename"], x.get("objname"), session)
+            for x in job["inputs"]]
+
+def draw(job, obs, options, labels, context = None):
+    '''Put the objects on an overlay and draw it, returns the PlotOverlay.
+       The overlay comes from context (a plt.RenderContext) if there is one
+    '''
+    stacked  = job["type"] == "stack" or job.get("stack") is True
+    leg_opt  = job.get("leg_opt", "F" if job["type"] == "stack" else "L")
+    draw_opt = job.get("draw_opt", "")
+    entries  = zip(obs, labels["names"], labels["leg_names"])
+
+    if context is not None:
+        po = context.overlay(**options)
+    else:
+        po = plt.PlotOverlay(**options)
+    if stacked:
+        hs = plt.HistStack(options)
+        for ob, name, leg_name in entries:
+            hs.add_hist(ob, name, leg_name, leg_opt)
+        po.add_stack(hs, "stack")
+    else:
+        for ob, name, leg_name in entries:
+            po.add_obj(ob, name, draw_opt, leg_opt, leg_name)
+    po.draw()
+    return po
+
+def input_labels(job):
+    '''The name and legend name of each input. The legend name falls back
+       on the name, as in PlotOverlay.add_obj
+    '''
+    names = [x.get("name", "n") for x in job["inputs"]]
+    return {"names"     : names,
+            "leg_names" : [x.get("leg_name") or name
+                           for x, name in zip(job["inputs"], names)]}
+
+def run_job(job, session = None, compiler = None, obs = None, context = None):
+    '''Draw and write out a single plot job, reading its objects unless they're
+       given. Returns (outfile, cache key), or None if the cache had the plot.
+       PDFs are left to compiler if there is one. With a context (a 
+       plt.RenderContext) the canvas and legend are reused and the objects
+       let go of once written
+    '''
+    with profiler.for_plot(describe(job)):
+        return run_plot(job, session, compiler, obs, context)
+
+def run_plot(job, session, compiler, obs, context = None):
+    '''Does the work for run_job
+    '''
+    if obs is None:
+        obs = load(job, session)
+    outfile = get_outfile(job, obs)
+    ext     = os.path.splitext(outfile)[1]
+    options, labels, replace_dict = parse.prepare_for_ext(
+        overlay_options(job.get("options", {})), input_labels(job), ext)
+
+    render_cache = None
+    cache_key = None
+    if job.get("cache_dir"):
+        render_cache = cache.RenderCache(job["cache_dir"])
+        drawing = [job["type"], job.get("stack"), job.get("draw_opt"), job.get("leg_opt"),
+                   job.get("backend")]
+        with profiler.stage("cache"):
+            cache_key = cache.make_key(obs, [options, labels, drawing], replace_dict, ext)
+            hit = render_cache.fetch(cache_key, outfile)
+        if hit:
+            # nothing will draw them, let them go with the caller's references
+            for ob in obs:
+                plt.take_ownership(ob)
+            return None
+
+    po = draw(job, obs, options, labels, context)
+    overlay = po if job.get("backend") == "pgfplots" else None
+    try:
+        paintit(po.canvas, outfile, replace_dict, compiler, render_cache, cache_key, overlay)
+    finally:
+        if context is not None:
+            context.release(po)
+    return outfile, cache_key
+
+def run_page(job, document, session = None, obs = None, context = None):
+    '''Draw a plot job on the canvas of document (a paint.MultiPage) and
+       add it as the next page, named for the first object. ROOT writes the
+       page itself, so labels go in as they are and there's no cache. With
+       a context the legend is reused and the objects let go of once the
+       page is written, as in run_job
+    '''
+    with profiler.for_plot(describe(job)):
+        if obs is None:
+            obs = load(job, session)
+        options = dict(overlay_options(job.get("options", {})), canvas = document.canvas)
+        po = draw(job, obs, options, input_labels(job), context)
+        try:
+            document.add(po.canvas, obs[0].GetName())
+        finally:
+            if context is not None:
+                context.release(po)
+
+def finish_batch(compiler, drawn):
+    '''Compile the PDFs left to compiler, then store the ones that built in 
+       their job's cache. drawn is (job, run_job result) for each plot drawn.
+       Returns the compile failures
+    '''
+    drawn = [(job, res) for job, res in drawn if res is not None]
+    for job, (outfile, cache_key) in drawn:
+        compiler.add(outfile)
+    failures = compiler.finish()
+
+    failed = set(x[0] for x in failures)
+    for job, (outfile, cache_key) in drawn:
+        if job.get("cache_dir") and paint.tex_names(outfile)[0] + ".pdf" not in failed:
+            cache.RenderCache(job["cache_dir"]).store(cache_key, outfile)
+    return failures
+
+def absolute_paths(job):
+    '''Copy of job with every path made absolute, for sending to a server
+       running somewhere else
+    '''
+    job = dict(job)
+    job["inputs"] = [dict(x, filename = os.path.abspath(x["filename"]))
+                     for x in job["inputs"]]
+    for path in ("outfile", "cache_dir"):
+        if job.get(path):
+            job[path] = os.path.abspath(job[path])
+    job["prefix"] = os.path.join(os.getcwd(), job.get("prefix", ""))
+    return job
+
+def submit(socket_path, job):
+    '''Send a job to a render server (bin/stencil_server) and wait for the reply
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        conn.sendall((json.dumps(absolute_paths(job)) + "\n").encode())
+        conn.shutdown(socket.SHUT_WR)
+        reply = conn.makefile("r").readline()
+    finally:
+        conn.close()
+    if not reply:
+        return {"ok" : False, "outfiles" : [],
+                "failures" : [["server", "connection closed without a reply"]]}
+    return json.loads(reply)
+
+def report_reply(reply, stream = sys.stderr):
+    '''Write out anything that failed on the server, returns the exit status
+    '''
+    for item, err in reply["failures"]:
+        stream.write("Failed on {0}:\n{1}\n".format(item, err))
+    return 0 if reply["ok"] else 1
@@ -0,0 +1,30 @@
+'''ROOT takes seconds to import, so the modules here get it through a proxy
+   that only imports it the first time something is looked up on it. That
+   way --help, and anything else that never touches ROOT, doesn't pay for it
+'''
+import sys
+
+class LazyRoot(object):
+    '''Stands in for the ROOT module until it's needed
+    '''
+    def __init__(self):
+        self.module = None
+
+    def load(self):
+        '''Import ROOT, keeping it away from our command line options
+        '''
+        if self.module is None:
+            import ROOT as module
+            module.PyConfig.IgnoreCommandLineOptions = True
+            self.module = module
+        return self.module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+ROOT = LazyRoot()
+
+def root_loaded():
+    '''Has anything imported ROOT yet?
+    '''
+    return "ROOT" in sys.modules
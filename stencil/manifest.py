@@ -0,0 +1,143 @@
+'''Run hundreds of plots from one manifest, a JSON file like
+
+    {"defaults" : {"options" : {"color_scheme" : "default"}, "ext" : "pdf"},
+     "plots"    : [<plot job>, <plot job>, ...]}
+
+   where each plot is a job as described in stencil.jobs, with any fields
+   (or options) it leaves out taken from "defaults". A bare list of jobs works too. The run
+   is planned up front so, drawing in one process, each input file is opened
+   once and each object is read once, however many plots use it. Objects are
+   read just before the first plot that needs them and dropped after the last
+'''
+from collections import OrderedDict
+import json
+import stencil.rio as rio
+import stencil.plot as plt
+import stencil.jobs as jobs
+import stencil.batch as batch
+
+def to_str(ob):
+    '''ob with every unicode string from JSON made a utf-8 str, as the same
+       label would be given on the command line, so latex labels (and
+       anything outside ascii) are handled the same either way
+    '''
+    if isinstance(ob, unicode):
+        return ob.encode("utf-8")
+    if isinstance(ob, list):
+        return [to_str(x) for x in ob]
+    if isinstance(ob, dict):
+        return dict((to_str(k), to_str(v)) for k, v in ob.iteritems())
+    return ob
+
+def read_manifest(filename):
+    '''The plot jobs listed in a manifest file, defaults filled in
+    '''
+    with open(filename) as f:
+        manifest = to_str(json.load(f))
+    if isinstance(manifest, list):
+        manifest = {"plots" : manifest}
+    defaults = manifest.get("defaults", {})
+    plot_jobs = []
+    for plot in manifest["plots"]:
+        job = dict(defaults, **plot)
+        # options are merged rather than replaced
+        job["options"] = dict(defaults.get("options", {}), **plot.get("options", {}))
+        plot_jobs.append(job)
+    return plot_jobs
+
+def clone(ob):
+    '''A private copy of an object for a plot to style as it likes
+    '''
+    copy = ob.Clone()
+    if rio.is_histogram(copy):
+        copy.SetDirectory(0)
+    return copy
+
+class Plan(object):
+    '''Every plot in a manifest and every object they need, grouped by file
+    '''
+    def __init__(self, plot_jobs, session = None):
+        '''Split up shared jobs and work out which objects each plot uses.
+           Inputs with no objname are pinned to the first key in their file
+        '''
+        self.session = rio.get_session(session)
+        self.plots = []
+        for job in plot_jobs:
+            self.plots.extend(jobs.expand(job, self.session))
+
+        self.reads = OrderedDict()
+        self.uses  = {}
+        for plot in self.plots:
+            for inp in plot["inputs"]:
+                if inp.get("objname") is None:
+                    inp["objname"] = self.session.get_keys(inp["filename"])[0]
+                needed = (inp["filename"], inp["objname"])
+                self.reads.setdefault(needed[0], [])
+                if needed not in self.uses:
+                    self.reads[needed[0]].append(needed[1])
+                    self.uses[needed] = 0
+                self.uses[needed] += 1
+        self.store = {}
+
+    def read_file(self, filename):
+        '''Read the objects still to be used from filename, then let it go
+        '''
+        for objname in self.reads[filename]:
+            needed = (filename, objname)
+            if self.uses[needed] > 0 and needed not in self.store:
+                self.store[needed] = self.session.grab_obj(filename, objname)
+        self.session.close(filename)
+
+    def objects_for(self, plot):
+        '''The objects for a plot. A file is read when the first plot that
+           needs it comes up, and each object is dropped after its last plot.
+           Plots restyle their objects, so each gets a clone unless it's the
+           last one to use the object
+        '''
+        obs = []
+        for inp in plot["inputs"]:
+            needed = (inp["filename"], inp["objname"])
+            if needed not in self.store:
+                self.read_file(needed[0])
+            self.uses[needed] -= 1
+            if self.uses[needed] > 0:
+                obs.append(clone(self.store[needed]))
+            else:
+                obs.append(self.store.pop(needed))
+        return obs
+
+# the run in progress, where forked workers can find it
+active = {}
+
+def render_plot(i):
+    '''Draw plot i of the active plan. Workers can't share the use counts,
+       so in parallel each plot reads its own objects, through the worker's
+       session
+    '''
+    plan = active["plan"]
+    plot = plan.plots[i]
+    if active["n_jobs"] > 1:
+        obs = [rio.grab_obj(x["filename"], x["objname"]) for x in plot["inputs"]]
+    else:
+        obs = plan.objects_for(plot)
+    return jobs.run_job(plot, compiler = active["compiler"], obs = obs,
+                        context = active["context"])
+
+def run(plot_jobs, n_jobs = 1, compiler = None, session = None):
+    '''Plan and draw every plot, in n_jobs worker processes if more than one.
+       PDFs are left to compiler if there is one. Returns the failures as
+       (plot, traceback) pairs in manifest order
+    '''
+    plan = Plan(plot_jobs, session)
+    # each worker gets its own copy of the (empty) context
+    active.update(plan = plan, compiler = compiler, n_jobs = n_jobs,
+                  context = plt.RenderContext())
+    try:
+        drawn, failures = batch.run_each(render_plot, range(len(plan.plots)), n_jobs)
+    finally:
+        active.clear()
+
+    failures = [(jobs.describe(plan.plots[i]), err) for i, err in failures]
+    if compiler is not None:
+        failures.extend(jobs.finish_batch(compiler, zip(plan.plots, drawn)))
+    return failures
@@ -1,40 +1,194 @@
 """Tools for writing out ROOT canvases to different formats
 """
 from string import Template
+from collections import OrderedDict
 import subprocess
+import tempfile
+import hashlib
+import shutil
+import json
+import re
 import os
+import stencil.pgfplots as pgfplots
+from stencil.lazy import ROOT
+from stencil.timing import profiler
 
-standalone_template = Template(r'''
+standalone_preamble = r'''
 \documentclass[tikz]{standalone}
 \usepackage{tikz}
 \usetikzlibrary{patterns}
 \usetikzlibrary{plotmarks}
-\begin{document}
+'''
+
+standalone_template = Template(standalone_preamble + r'''\begin{document}
 \input{$filename}
 \end{document}
 ''')
 
+# the standalone class puts each tikzpicture on its own page
+batch_template = Template(r'''$preamble\begin{document}
+$inputs
+\end{document}
+''')
+
+def make_replacer(replace_dict):
+    '''A function making every substitution in replace_dict on a string in
+       one pass. Keys only match as whole words, so a placeholder can't be
+       picked up inside a number or another word. Longest keys win
+    '''
+    keys = sorted(replace_dict, key = len, reverse = True)
+    pattern = re.compile(r"(?<![A-Za-z0-9])(" + "|".join(re.escape(k) for k in keys) + 
+                         r")(?![A-Za-z0-9])")
+    return lambda line: pattern.sub(lambda match: replace_dict[match.group(1)], line)
+
 def fix_tex(tex_file, replace_dict):
-    '''Open a tex file and replace keys with values from replace_dict
+    '''Replace keys with values from replace_dict in a tex file, streaming 
+       it through once line by line rather than holding it all in memory
     '''
-    with open(tex_file) as f:
-        contents = f.read()
-    for k, v in replace_dict.iteritems():
-        contents = contents.replace(k, v)
-    with open(tex_file, "w") as f:
-        f.write(contents)
+    if not replace_dict:
+        return
+    replace = make_replacer(replace_dict)
+    tmp_name = tex_file + ".tmp"
+    with profiler.stage("fix_tex"):
+        with open(tex_file) as f, open(tmp_name, "w") as out:
+            for line in f:
+                out.write(replace(line))
+        os.rename(tmp_name, tex_file)
 
-def make_standalone(tex_file, st_al_fname):
+def make_standalone(tex_file, st_al_fname, template = standalone_template):
     '''Write a short latex document that makes a standalone pdf of one figure
     '''
-    contents = standalone_template.substitute(filename = os.path.abspath(tex_file))
+    contents = template.substitute(filename = os.path.abspath(tex_file))
     with open(st_al_fname, "w") as f:
         f.write(contents)
 
+# Precompiled formats: pdflatex -ini with a preamble then \dump saves TeX's
+# state after the preamble, so later runs load it instead of reading the
+# class and packages again. Kept by hash of preamble and TeX version in
+# $STENCIL_FMT_DIR (or ~/.cache/stencil), switched off with use_formats.
+# A compile that fails with a format is run again without one, and if that
+# works the format isn't used again by this process
+use_formats = True
+
+# preamble -> format path (None if it couldn't be built), for this process
+formats = {}
+
+def format_dir():
+    '''Where precompiled formats are kept
+    '''
+    return os.environ.get("STENCIL_FMT_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "stencil")
+
+def tex_version():
+    '''First line of pdflatex --version, formats only load in the TeX that
+       made them. None if there's no pdflatex
+    '''
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["pdflatex", "--version"], 
+                                           stderr = devnull).splitlines()[0]
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def build_format(preamble):
+    '''Path (no extension) of a format with preamble loaded, building it
+       if it isn't in the format directory. None if it can't be built
+    '''
+    version = tex_version()
+    if version is None:
+        return None
+    name = "stencil-" + hashlib.md5(version + preamble).hexdigest()[:16]
+    base = os.path.join(format_dir(), name)
+    if os.path.exists(base + ".fmt"):
+        return base
+
+    work_dir = tempfile.mkdtemp(prefix = "stencil_fmt")
+    try:
+        tex_name = os.path.join(work_dir, name + ".tex")
+        with open(tex_name, "w") as f:
+            f.write(preamble + "\\dump\n")
+        with profiler.stage("build_format"), open(os.devnull, "w") as devnull:
+            status = subprocess.call(["pdflatex", "-ini", "-interaction=nonstopmode",
+                                      "-jobname=" + name, "-output-directory", work_dir,
+                                      "&pdflatex", tex_name], stdout = devnull)
+        built = os.path.join(work_dir, name + ".fmt")
+        if status != 0 or not os.path.exists(built):
+            return None
+        if not os.path.isdir(format_dir()):
+            os.makedirs(format_dir())
+        # moved in whole, so a parallel build or compile never sees half of one
+        shutil.move(built, base + ".fmt.tmp")
+        os.rename(base + ".fmt.tmp", base + ".fmt")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+    return base
+
+def get_format(preamble):
+    '''The format for preamble, built at most once per process
+    '''
+    if not use_formats:
+        return None
+    if preamble not in formats:
+        formats[preamble] = build_format(preamble)
+    return formats[preamble]
+
+def split_document(tex_file):
+    '''The preamble and the rest of a latex document
+    '''
+    with open(tex_file) as f:
+        contents = f.read()
+    preamble, found, body = contents.partition(r"\begin{document}")
+    return preamble, found + body
+
+def latex_command(tex_file, output_dir, use_format = True):
+    '''pdflatex arguments to compile tex_file into output_dir. With a format
+       for its preamble only the document body is passed, on the command line
+    '''
+    command = ["pdflatex", "-interaction=nonstopmode", "-halt-on-error",
+               "-output-directory", output_dir]
+    preamble, body = split_document(tex_file)
+    fmt = get_format(preamble) if use_format else None
+    if fmt is None:
+        return command + [tex_file]
+    return command + ["-fmt=" + fmt, 
+                      "-jobname=" + os.path.splitext(os.path.basename(tex_file))[0],
+                      " ".join(body.splitlines())]
+
+def with_format(command):
+    '''Does a pdflatex command load a precompiled format?
+    '''
+    return any(x.startswith("-fmt=") for x in command)
+
+def compile_without_format(tex_file, output_dir, stdout = None):
+    '''Compile tex_file reading its whole preamble, after a compile with its
+       format failed. If this works the format was at fault, so it's dropped
+       for the rest of the process. Returns pdflatex's exit status
+    '''
+    with profiler.stage("pdflatex_no_format"):
+        status = subprocess.call(latex_command(tex_file, output_dir, use_format = False),
+                                 stdout = stdout)
+    if status == 0:
+        formats[split_document(tex_file)[0]] = None
+    return status
+
+def run_latex(tex_file, output_dir, stdout = None):
+    '''Compile tex_file into output_dir, falling back on the full preamble
+       if the format fails. Returns pdflatex's exit status
+    '''
+    command = latex_command(tex_file, output_dir)
+    status = subprocess.call(command, stdout = stdout)
+    if status != 0 and with_format(command):
+        status = compile_without_format(tex_file, output_dir, stdout)
+    return status
+
 def compile_standalone(tex_file):
     '''Run pdflatex to get the standalone
     '''
-    return subprocess.check_call("pdflatex  -output-directory {0} {1}".format(os.path.dirname(tex_file), tex_file) , shell = True)
+    with profiler.stage("pdflatex"):
+        status = run_latex(tex_file, os.path.dirname(tex_file))
+    if status != 0:
+        raise subprocess.CalledProcessError(status, "pdflatex " + tex_file)
+    return status
 
 
 def clean_pdflatex_files(bs_name):
@@ -47,27 +201,309 @@ def clean_pdflatex_files(bs_name):
             pass
 
 
-def save_as_tex_pdf(canvas, outname, replace_dict = None):
-    '''Write a canvas to tex, create a standalone and compile it to PDF. Outname needs no extension
+def tex_names(outname):
+    '''The base name, tikz input and standalone wrapper used to make 
+       the PDF outname
+    '''
+    outname = os.path.splitext(os.path.abspath(outname))[0]
+    return outname, outname + "_input.tex", outname + ".tex"
+
+def save_as_tex_pdf(canvas, outname, replace_dict = None, compiler = None):
+    '''Write a canvas to tex, create a standalone and compile it to PDF. Outname needs no extension.
+       If a compiler (e.g. a TexBatch) is given the compile is left to it
     '''
     if replace_dict is None:
         replace_dict = {}
 
-    outname = os.path.splitext(os.path.abspath(outname))[0]
-    tex_name = outname + "_input.tex"
-    st_al_fname = outname + ".tex"
+    outname, tex_name, st_al_fname = tex_names(outname)
 
-    canvas.SaveAs(tex_name)
+    with profiler.stage("save_as"):
+        canvas.SaveAs(tex_name)
     fix_tex(tex_name, replace_dict)
     make_standalone(tex_name, st_al_fname)
+    if compiler is not None:
+        compiler.add(outname)
+        return
     compile_standalone(st_al_fname)
     clean_pdflatex_files(outname)
 
+def save_as_pgfplots_pdf(overlay, outname, replace_dict = None, compiler = None):
+    '''Write a drawn PlotOverlay as a pgfplots figure, skipping ROOT's tex 
+       output, and build the PDF as save_as_tex_pdf does. Labels go in as 
+       they are, placeholders are swapped back while writing
+    '''
+    if replace_dict is None:
+        replace_dict = {}
+
+    outname, tex_name, st_al_fname = tex_names(outname)
 
-def paintit(can, outfile, replace_dict):
-    '''Umbrella method to choose a print option based on ext
+    with profiler.stage("save_as"):
+        pgfplots.write_tex(overlay, tex_name, replace_dict)
+    make_standalone(tex_name, st_al_fname, pgfplots.pgf_template)
+    if compiler is not None:
+        compiler.add(outname)
+        return
+    compile_standalone(st_al_fname)
+    clean_pdflatex_files(outname)
+
+
+def log_errors(log_name):
+    '''Pull the error lines out of a pdflatex log
+    '''
+    try:
+        with open(log_name) as f:
+            errors = [x.rstrip() for x in f if x.startswith("!")]
+    except IOError:
+        return "no log written"
+    return "\n".join(errors) or "pdflatex failed"
+
+def count_pages(log_name):
+    '''How many pages pdflatex says it wrote, None if it didn't say
+    '''
+    with open(log_name) as f:
+        found = re.search(r"Output written on.*?\((\d+)\s+pages?", f.read(), re.S)
+    if found is None:
+        return None
+    return int(found.group(1))
+
+def read_preamble(st_al_fname):
+    '''Everything before the document in a standalone wrapper
+    '''
+    try:
+        return split_document(st_al_fname)[0]
+    except IOError:
+        return standalone_preamble
+
+
+def on_path(program):
+    '''Is there an executable called program on the PATH?
+    '''
+    return any(os.access(os.path.join(x, program), os.X_OK)
+               for x in os.environ.get("PATH", "").split(os.pathsep))
+
+
+class TexBatch(object):
+    '''Queue up standalone figures and compile them together in one pdflatex
+       run, one page per figure, then split the pages back out into the same
+       per figure PDFs save_as_tex_pdf makes. Figures are grouped by the
+       preamble of their standalone wrapper (tikz or pgfplots). Needs pdfseparate (poppler) on 
+       the path to do the split
+    '''
+    def __init__(self, max_batch = 200):
+        '''Figures are compiled in runs of at most max_batch, to stay well
+           inside TeX memory limits. Fails straight away, rather than after
+           everything is drawn, if there's no pdfseparate
+        '''
+        if not on_path("pdfseparate"):
+            raise OSError("TexBatch needs pdfseparate (from poppler) on the path")
+        self.max_batch = max_batch
+        # used as an ordered set of output names
+        self.queued    = OrderedDict()
+
+    def add(self, outname):
+        '''Queue a figure by output name. The tikz input and standalone must 
+           already be written. Adding the same figure twice queues it once
+        '''
+        outname = tex_names(outname)[0]
+        self.queued[outname] = None
+
+    def compile_together(self, outnames, work_dir, preamble):
+        '''Try compiling a group of figures in one document. Returns None 
+           on success, or the errors from the log
+        '''
+        doc_name = os.path.join(work_dir, "batch.tex")
+        inputs = "\n".join(r"\input{{{0}}}".format(tex_names(x)[1]) for x in outnames)
+        with open(doc_name, "w") as f:
+            f.write(batch_template.substitute(preamble = preamble, inputs = inputs))
+
+        log_name = os.path.join(work_dir, "batch.log")
+        with profiler.stage("pdflatex_batch"), open(os.devnull, "w") as devnull:
+            status = run_latex(doc_name, work_dir, devnull)
+        if status != 0:
+            return log_errors(log_name)
+        if count_pages(log_name) != len(outnames):
+            return "expected one page per figure"
+
+        pattern = os.path.join(work_dir, "page-%d.pdf")
+        try:
+            subprocess.check_call(["pdfseparate", os.path.join(work_dir, "batch.pdf"), pattern])
+        except (OSError, subprocess.CalledProcessError) as err:
+            return "couldn't split the pages: " + repr(err)
+        for i, outname in enumerate(outnames):
+            shutil.move(pattern % (i + 1), outname + ".pdf")
+        return None
+
+    def compile_group(self, outnames, work_dir, preamble):
+        '''Compile a group, splitting it in half on failure until the 
+           broken figures are found. Returns (outname, errors) for each
+        '''
+        if not outnames:
+            return []
+        errors = self.compile_together(outnames, work_dir, preamble)
+        if errors is None:
+            return []
+        if len(outnames) == 1:
+            return [(outnames[0] + ".pdf", errors)]
+        half = len(outnames) // 2
+        return (self.compile_group(outnames[:half], work_dir, preamble) + 
+                self.compile_group(outnames[half:], work_dir, preamble))
+
+    def finish(self):
+        '''Compile everything queued. Returns (pdf name, errors) for each figure 
+           that failed, the rest are written regardless
+        '''
+        groups = OrderedDict()
+        for outname in self.queued:
+            groups.setdefault(read_preamble(tex_names(outname)[2]), []).append(outname)
+        self.queued.clear()
+        failures = []
+        work_dir = tempfile.mkdtemp(prefix = "stencil_batch")
+        try:
+            for preamble, outnames in groups.iteritems():
+                for i in range(0, len(outnames), self.max_batch):
+                    failures.extend(self.compile_group(outnames[i:i + self.max_batch],
+                                                       work_dir, preamble))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors = True)
+        return failures
+
+
+class CompileQueue(object):
+    '''Compile standalone figures in the background while the next ones are
+       drawn, cleaning up after each. At most max_running pdflatex runs go at
+       once, adding another waits for a slot. Same interface as TexBatch
+    '''
+    def __init__(self, max_running = 2):
+        '''Figures added from any process but this one (pool workers) are
+           ignored, the parent adds them again once they're drawn
+        '''
+        self.max_running = max_running
+        self.owner    = os.getpid()
+        # outname -> (pdflatex process, whether it loads a format), oldest first
+        self.running  = OrderedDict()
+        self.started  = set()
+        self.failures = []
+
+    def add(self, outname):
+        '''Start compiling a figure by output name, once there's room. The
+           tikz input and standalone must already be written. Adding the same
+           figure twice compiles it once
+        '''
+        outname = tex_names(outname)[0]
+        if os.getpid() != self.owner or outname in self.started:
+            return
+        self.reap()
+        while len(self.running) >= self.max_running:
+            self.wait_for(next(iter(self.running)))
+        self.started.add(outname)
+        command = latex_command(tex_names(outname)[2], os.path.dirname(outname))
+        with open(os.devnull, "r+") as devnull:
+            self.running[outname] = (subprocess.Popen(command, stdin = devnull,
+                                                      stdout = devnull),
+                                     with_format(command))
+
+    def reap(self):
+        '''Collect any compiles that have finished
+        '''
+        for outname, (proc, fmt) in list(self.running.items()):
+            if proc.poll() is not None:
+                self.wait_for(outname)
+
+    def wait_for(self, outname):
+        '''Wait for one compile, noting its errors if it failed. One that
+           failed with a format is run again, here, without it
+        '''
+        proc, fmt = self.running.pop(outname)
+        with profiler.stage("pdflatex_wait"):
+            status = proc.wait()
+        if status != 0 and fmt:
+            with open(os.devnull, "w") as devnull:
+                status = compile_without_format(tex_names(outname)[2],
+                                                os.path.dirname(outname), devnull)
+        if status != 0:
+            self.failures.append((outname + ".pdf", log_errors(outname + ".log")))
+        clean_pdflatex_files(outname)
+
+    def finish(self):
+        '''Wait for everything added. Returns (pdf name, errors) for each 
+           figure that failed
+        '''
+        while self.running:
+            self.wait_for(next(iter(self.running)))
+        failures = self.failures
+        self.failures = []
+        self.started.clear()
+        return failures
+
+
+class MultiPage(object):
+    '''One PDF or PS document with a page per plot, all drawn on the same
+       canvas and written by ROOT as they come, rather than a file each.
+       An index of page number to object name goes next to it as JSON
+    '''
+    def __init__(self, filename, canvas = None):
+        '''The document is opened with the first page. A canvas is made
+           if none is given
+        '''
+        self.filename = filename
+        self.canvas   = canvas if canvas is not None else ROOT.TCanvas()
+        self.names    = []
+
+    def index_name(self):
+        '''Where the page index goes, e.g. sweep.json for sweep.pdf
+        '''
+        return os.path.splitext(self.filename)[0] + ".json"
+
+    def add(self, canvas, name, title = None):
+        '''Print canvas as the next page, for the object called name (or
+           anything else that goes in a JSON index). title defaults to name
+        '''
+        if title is None:
+            title = name
+        # titles become the PDF table of contents
+        option = "Title:" + title if self.filename.endswith(".pdf") else ""
+        with profiler.stage("print_page"):
+            if not self.names:
+                canvas.Print(self.filename + "[")
+            canvas.Print(self.filename, option)
+        self.names.append(name)
+
+    def close(self):
+        '''Finish the document and write its index, returns the index
+        '''
+        if self.names:
+            self.canvas.Print(self.filename + "]")
+        index = OrderedDict((str(i + 1), nm) for i, nm in enumerate(self.names))
+        with open(self.index_name(), "w") as f:
+            json.dump(index, f, indent = 1)
+        return index
+
+
+def paintit(can, outfile, replace_dict, compiler = None, cache = None, cache_key = None,
+            overlay = None):
+    '''Umbrella method to choose a print option based on ext. PDFs
+       are left to compiler to build, if one is given. Given the drawn 
+       PlotOverlay, PDFs are written with pgfplots, unless it holds something
+       only ROOT's tex output can do. If there's a cache the finished plot is
+       stored under cache_key, unless a compiler was given - then it is up to
+       the caller to store it once compiled
     '''
     if os.path.splitext(outfile)[1] == ".pdf":
-        save_as_tex_pdf(can, outfile, replace_dict)
+        written = False
+        if overlay is not None:
+            try:
+                save_as_pgfplots_pdf(overlay, outfile, replace_dict, compiler)
+                written = True
+            except pgfplots.Unsupported:
+                # nothing was written, ROOT can do it
+                pass
+        if not written:
+            save_as_tex_pdf(can, outfile, replace_dict, compiler)
+        if compiler is not None:
+            return
     else:
-        can.SaveAs(outfile)
+        with profiler.stage("save_as"):
+            can.SaveAs(outfile)
+
+    if cache is not None:
+        cache.store(cache_key, outfile)
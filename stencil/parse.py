@@ -66,17 +66,39 @@ class ConstructorParser(object):
         return for_constr, other_parts
 
 def is_latex(st):
-    '''Is this a math mode latex str?
+    '''Is this a math mode latex str? Strings from JSON (jobs, manifests)
+       are unicode
     '''
-    return type(st) == str and ("$" in st)
+    return isinstance(st, basestring) and ("$" in st)
 
-def unique_id(st):
+# Placeholder letters. ROOT's numeric output is digits, '.', '-' and 'e'/'E', 
+# and the tikz keywords are lower case, so upper case letters without E 
+# can't be mistaken for either
+uid_letters = "ABCDFGHJKLMNPQRS"
+
+def unique_id(st, salt = ""):
     '''Make the identifiers close to unique. We dont want e.g. 
        x_title and title confused. Hash gives names much longer than 
        the eventual strings so text comes out tiny. Truncate here to 
-       correct length (at small risk of collisions)
+       correct length (at small risk of collisions, which make_replace_dict
+       resolves with a salt). Each hex digit of the hash becomes one of
+       uid_letters
+    '''
+    text = st + salt
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    digest = hashlib.md5(text).hexdigest()[:min(len(st), 5)]
+    return "".join(uid_letters[int(x, 16)] for x in digest)
+
+def fresh_id(st, replace_dict):
+    '''A unique_id for st that isn't already standing in for another string
     '''
-    return str(hashlib.md5(st).hexdigest())[:min(len(st), 5)]
+    uid = unique_id(st)
+    salt = 0
+    while replace_dict.get(uid, st) != st:
+        salt += 1
+        uid = unique_id(st, str(salt))
+    return uid
 
 def make_replace_dict(config, replace_dict):
     '''To use the tex output we need to hide math mode from ROOT
@@ -87,16 +109,17 @@ def make_replace_dict(config, replace_dict):
     '''
     for k, v in config.iteritems():
         if is_latex(v):
-            uid = unique_id(v)
+            uid = fresh_id(v, replace_dict)
             replace_dict[uid] = v
             config[k] = uid
 
         if type(v) == list and any(is_latex(x) for x in v):
             names = v
-            uids = [unique_id(x) for x in v]
+            uids = []
+            for nm in names:
+                uids.append(fresh_id(nm, replace_dict))
+                replace_dict[uids[-1]] = nm
             config[k] = uids
-            for nm, uid in zip(names, uids):
-                replace_dict[uid] = nm
     return config, replace_dict
             
 def making_pdf(extension):
@@ -0,0 +1,352 @@
+'''Native PGFPlots output. Rather than the drawing primitive per bin tikz
+   that canvas.SaveAs(".tex") makes, write one compact pgfplots axis straight
+   from the bin arrays and settings of a drawn PlotOverlay. 1D histograms
+   are merged down to the bins the canvas has pixels for and written as a
+   table, 2D ones are drawn to a PNG of the canvas size that the axis places.
+   However fine the binning, the tex stays small enough to compile in
+   seconds and inside TeX memory
+'''
+from string import Template
+import struct
+import zlib
+import os
+import numpy as np
+from stencil.lazy import ROOT
+import stencil.bins as bins
+import stencil.rio as rio
+
+pgf_preamble = r'''
+\documentclass[tikz]{standalone}
+\usepackage{pgfplots}
+\pgfplotsset{compat=1.9}
+'''
+
+pgf_template = Template(pgf_preamble + r'''\begin{document}
+\input{$filename}
+\end{document}
+''')
+
+# ROOT line styles pgfplots has a name for, anything else is drawn solid
+line_styles = {2 : "dashed", 3 : "dotted", 4 : "dashdotted"}
+
+# colour maps run evenly through these, blue for the lowest content
+map_colors = [(0., 0., 1.), (0., 1., 1.), (1., 1., 0.), (1., 0.5, 0.), (1., 0., 0.)]
+
+tex_specials = {"\\" : r"\textbackslash{}", "{" : r"\{", "}" : r"\}",
+                "_" : r"\_", "^" : r"\^{}", "%" : r"\%", "&" : r"\&",
+                "#" : r"\#", "$" : r"\$", "~" : r"\~{}"}
+
+def escape(text):
+    '''Make plain text safe to put in a tex document
+    '''
+    return "".join(tex_specials.get(x, x) for x in text)
+
+def label_tex(text, replace_dict):
+    '''The tex for a label. Placeholders made for the tikz route go back
+       to the latex they stand for, plain text is escaped
+    '''
+    if text in replace_dict:
+        return replace_dict[text]
+    return escape(text)
+
+def number(x):
+    '''Short but exact enough text for a table entry
+    '''
+    return "{0:.6g}".format(x)
+
+def table(columns):
+    '''An inline pgfplots table from (name, values) pairs
+    '''
+    names = " ".join(x[0] for x in columns)
+    rows  = zip(*[x[1] for x in columns])
+    return "{" + names + r"\\" + "\n" + "".join(
+        " ".join(number(x) for x in row) + r"\\" + "\n" for row in rows) + "}"
+
+def write_png(filename, rgb):
+    '''Write an 8 bit [rows, columns, 3] array as a PNG, top row first
+    '''
+    height, width = rgb.shape[:2]
+    def chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data +
+                struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+    # each row starts with filter type 0, none
+    raw = b"".join(b"\x00" + row.tobytes() for row in rgb)
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" +
+                chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+                chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+def pixel_bins(edges, n_pixels, log):
+    '''Which bin each of n_pixels evenly spread along the axis lands in.
+       Evenly in log space for a log axis
+    '''
+    if log and edges[0] > 0:
+        bounds = np.logspace(np.log10(edges[0]), np.log10(edges[-1]), n_pixels + 1)
+    else:
+        bounds = np.linspace(edges[0], edges[-1], n_pixels + 1)
+    centres = 0.5 * (bounds[:-1] + bounds[1:])
+    return np.clip(np.searchsorted(edges, centres, side = "right") - 1, 0, len(edges) - 2)
+
+class Unsupported(Exception):
+    '''The overlay holds something pgfplots output can't draw
+    '''
+    pass
+
+def address(ob):
+    '''Something to know a ROOT object by, PyROOT proxies aren't unique
+    '''
+    return ROOT.AddressOf(ob)[0]
+
+class Writer(object):
+    '''Builds the tex for one drawn overlay, collecting the colors it uses
+    '''
+    def __init__(self, overlay, replace_dict, image_base):
+        '''Legend labels are taken from the overlay's legend, by object.
+           Colour maps are written to image_base + _map<n>.png
+        '''
+        self.overlay = overlay
+        self.replace_dict = replace_dict
+        self.image_base = image_base
+        self.limits   = overlay.resolution()
+        self.images   = []
+        self.z_range  = None
+        self.colors   = {}
+        self.plots    = []
+        self.lowest   = None
+        self.highest  = None
+        self.colorbar = False
+        self.labels   = {}
+        if not overlay.no_legend:
+            for entry in overlay.legend.GetListOfPrimitives():
+                if entry.GetObject():
+                    self.labels[address(entry.GetObject())] = entry.GetLabel()
+
+    def color(self, index):
+        '''The name of a tikz color for a ROOT color index, defined on first use
+        '''
+        name = "rootcolor{0}".format(index)
+        if name not in self.colors:
+            col = ROOT.gROOT.GetColor(index)
+            rgb = (col.GetRed(), col.GetGreen(), col.GetBlue()) if col else (0., 0., 0.)
+            self.colors[name] = r"\definecolor{{{0}}}{{rgb}}{{{1}}}".format(
+                name, ",".join(number(x) for x in rgb))
+        return name
+
+    def line(self, ob):
+        '''pgfplots options for the line of ob
+        '''
+        opts = ["draw=" + self.color(ob.GetLineColor()),
+                "line width={0}pt".format(number(0.5 * ob.GetLineWidth()))]
+        if ob.GetLineStyle() in line_styles:
+            opts.append(line_styles[ob.GetLineStyle()])
+        return opts
+
+    def fill(self, ob):
+        '''pgfplots options for the fill of ob, none if it's hollow.
+           ROOT leaves fill colour 0 hollow
+        '''
+        if ob.GetFillColor() == 0 or ob.GetFillStyle() == 0:
+            return []
+        return ["fill=" + self.color(ob.GetFillColor()), "area legend"]
+
+    def add_plot(self, ob, opts, data, table_opts = "", closed = False):
+        '''Add one \\addplot, with a legend entry if ob has one
+        '''
+        label = self.labels.get(address(ob))
+        if label is None:
+            opts = opts + ["forget plot"]
+        self.plots.append(r"\addplot[{0}] table[{1}row sep=\\] {2}{3};".format(
+            ", ".join(opts), table_opts, data, r" \closedcycle" if closed else ""))
+        if label is not None:
+            self.plots.append(r"\addlegendentry{{{0}}}".format(
+                label_tex(label, self.replace_dict)))
+
+    def shrunk(self, arrays):
+        '''A copy of arrays merged down to the bins the canvas has pixels
+           for, arrays itself is left alone
+        '''
+        copy = bins.from_columns(arrays.dim, arrays.contents, arrays.errors, arrays.edges)
+        bins.downsample(copy, self.limits)
+        return copy
+
+    def track_range(self, values, tops = None):
+        '''Keep the lowest and highest values plotted, for the y axis. tops
+           are the upper ends (e.g. with error bars) if not the values
+        '''
+        if not len(values):
+            return
+        if tops is None:
+            tops = values
+        low, high = values.min(), tops.max()
+        self.lowest  = low if self.lowest is None else min(low, self.lowest)
+        self.highest = high if self.highest is None else max(high, self.highest)
+
+    def add_hist1d(self, hist, arrays, draw_opt, heights = None):
+        '''A histogram as steps, or as points with error bars for draw
+           option E. heights overrides the bin contents (for stacks)
+        '''
+        edges = arrays.edges[0]
+        if heights is None:
+            heights = arrays.contents[1:-1]
+        if "E" in draw_opt.upper():
+            self.track_range(heights, heights + arrays.errors[1:-1])
+            centres = 0.5 * (edges[:-1] + edges[1:])
+            opts = self.line(hist) + ["only marks", "mark=*", "mark size=1pt",
+                                      "error bars/.cd", "y dir=both", "y explicit"]
+            self.add_plot(hist, opts, table([("x", centres), ("y", heights),
+                                             ("e", arrays.errors[1:-1])]),
+                          "x=x, y=y, y error=e, ")
+            return
+        self.track_range(heights)
+        # const plot holds each value up to the next x, so repeat the last
+        fill = self.fill(hist)
+        self.add_plot(hist, self.line(hist) + fill + ["const plot"],
+                      table([("x", edges), ("y", np.append(heights, heights[-1:]))]),
+                      closed = bool(fill))
+
+    def add_hist2d(self, hist, arrays, draw_opt):
+        '''A 2D histogram as a colour map image, a pixel per pixel of the
+           canvas. Empty bins are left white, as ROOT leaves them
+        '''
+        po = self.overlay
+        x_edges, y_edges = arrays.edges[:2]
+        values = arrays.contents[1:-1, 1:-1]
+        # image rows run top down
+        cols = pixel_bins(x_edges, self.limits[0], po.log_x)
+        rows = pixel_bins(y_edges, self.limits[1], po.log_y)[::-1]
+        image = "{0}_map{1}.png".format(self.image_base, len(self.images))
+        # drawn once every map is in, so they share a colour scale
+        self.images.append((image, values[rows][:, cols]))
+        self.plots.append(
+            r"\addplot[forget plot] graphics[xmin={0}, xmax={1}, ymin={2}, ymax={3}] {{{4}}};"
+            .format(number(x_edges[0]), number(x_edges[-1]),
+                    number(y_edges[0]), number(y_edges[-1]), image))
+        if "Z" in draw_opt.upper():
+            self.colorbar = True
+
+    def draw_images(self):
+        '''Write the colour map images, on one scale from the lowest to the
+           highest filled bin of any of them, or to the maximum set on the
+           2D histograms (the colour scale ROOT would draw)
+        '''
+        filled = np.concatenate([x[1][x[1] != 0] for x in self.images])
+        low, high = (filled.min(), filled.max()) if len(filled) else (0., 1.)
+        maxima = self.maxima(2)
+        if maxima:
+            high = max(maxima)
+        self.z_range = (low, high)
+        stops = np.linspace(0., 1., len(map_colors))
+        for image, pixels in self.images:
+            scaled = (pixels - low) / (high - low) if high > low else np.zeros(pixels.shape)
+            rgb = np.dstack([np.interp(scaled, stops, [c[i] for c in map_colors])
+                             for i in range(3)])
+            rgb[pixels == 0] = 1.
+            write_png(image, np.round(255 * rgb).astype(np.uint8))
+
+    def add_stack(self, stack):
+        '''Each layer of a stack filled up to the running total, top layer
+           first so the ones below are drawn over it
+        '''
+        hists  = list(stack.GetHists())
+        arrays = [self.shrunk(bins.BinArrays(x)) for x in hists]
+        totals = np.cumsum([x.contents[1:-1] for x in arrays], axis = 0)
+        for hist, arr, heights in reversed(list(zip(hists, arrays, totals))):
+            self.add_hist1d(hist, arr, "", heights)
+
+    def add_graph(self, graph, draw_opt):
+        '''A graph as points, joined up if drawn with L or C
+        '''
+        n_points = graph.GetN()
+        xs = bins.buffer_to_array(graph.GetX(), n_points, np.float64)
+        ys = bins.buffer_to_array(graph.GetY(), n_points, np.float64)
+        self.track_range(ys)
+        opts = self.line(graph) + ["mark=*", "mark size=1pt"]
+        if not any(x in draw_opt.upper() for x in "LC"):
+            opts.append("only marks")
+        self.add_plot(graph, opts, table([("x", xs), ("y", ys)]))
+
+    def add(self, name):
+        '''Add the object called name on the overlay. Anything pgfplots
+           can't be given here raises Unsupported
+        '''
+        ob = self.overlay.obs[name]
+        draw_opt = self.overlay.draw_opts[name]
+        if ob.InheritsFrom("THStack"):
+            self.add_stack(ob)
+        elif rio.is_histogram(ob) and ob.GetDimension() < 3:
+            arrays = self.shrunk(self.overlay.bins.get(name) or bins.BinArrays(ob))
+            if ob.GetDimension() == 1:
+                self.add_hist1d(ob, arrays, draw_opt)
+            else:
+                self.add_hist2d(ob, arrays, draw_opt)
+        elif ob.InheritsFrom("TGraph"):
+            self.add_graph(ob, draw_opt)
+        else:
+            raise Unsupported("no pgfplots output for " + ob.ClassName())
+
+    def maxima(self, dim):
+        '''The maxima set on the histograms of dimension dim
+        '''
+        return [x.GetMaximumStored() for x in self.overlay.with_cap("bins")
+                if x.GetDimension() == dim and x.GetMaximumStored() != bins.unset]
+
+    def axis_options(self):
+        '''Titles, ranges, log axes and legend position from the overlay
+        '''
+        po = self.overlay
+        opts = ["title={{{0}}}".format(label_tex(po.title, self.replace_dict)),
+                "xlabel={{{0}}}".format(label_tex(po.x_title, self.replace_dict)),
+                "ylabel={{{0}}}".format(label_tex(po.y_title, self.replace_dict)),
+                "enlarge x limits=false", "unbounded coords=jump"]
+        if po.auto_scale_x:
+            extent = po.axis_extents(0, "xaxis")
+            if extent is not None:
+                opts.append("xmax=" + number(extent[1]))
+                # a log axis can't start at zero, leave that to pgfplots
+                if extent[0] > 0 or not po.log_x:
+                    opts.append("xmin=" + number(extent[0]))
+        # merging bins for the canvas can take them past the maximum set
+        # on the histogram, so it's only a lower limit
+        maxima = self.maxima(1)
+        if maxima and self.highest is not None:
+            maxima.append(self.highest)
+        if maxima:
+            opts.append("ymax=" + number(max(maxima)))
+        if po.log_x:
+            opts.append("xmode=log")
+        if po.log_y:
+            opts.append("ymode=log")
+        elif self.lowest is not None and self.lowest >= 0:
+            opts.append("ymin=0")
+        if self.images:
+            opts += ["colormap={stencil}{" + " ".join(
+                         "rgb=({0})".format(",".join(number(x) for x in c)) for c in map_colors) + "}",
+                     "point meta min=" + number(self.z_range[0]),
+                     "point meta max=" + number(self.z_range[1]),
+                     "axis on top"]
+        if self.colorbar:
+            opts.append("colorbar")
+        leg = po.legend
+        opts.append("legend style={{at={{({0},{1})}}, anchor=north west}}".format(
+            number(leg.GetX1NDC()), number(leg.GetY2NDC())))
+        return opts
+
+    def write(self):
+        '''The whole tikzpicture
+        '''
+        for name in self.overlay.obs:
+            self.add(name)
+        if self.images:
+            self.draw_images()
+        axis = "\\begin{{axis}}[{0}]\n".format(",\n  ".join(self.axis_options()))
+        return ("\n".join(sorted(self.colors.values())) + "\n\\begin{tikzpicture}\n" +
+                axis + "\n".join(self.plots) + "\n\\end{axis}\n\\end{tikzpicture}\n")
+
+def write_tex(overlay, tex_name, replace_dict):
+    '''Write a drawn PlotOverlay to tex_name as a pgfplots figure, with any
+       colour map images beside it. Raises Unsupported, before
+       writing anything, if the overlay holds something pgfplots output can't do
+    '''
+    contents = Writer(overlay, replace_dict, os.path.splitext(tex_name)[0]).write()
+    with open(tex_name, "w") as f:
+        f.write(contents)
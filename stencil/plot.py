@@ -1,9 +1,10 @@
 ''' Tools for putting ROOT objects onto canvas
 '''
-import ROOT
-ROOT.PyConfig.IgnoreCommandLineOptions = True
+from stencil.lazy import ROOT
 import stencil.rio as rio
 import stencil.color as color
+import stencil.bins as bins
+from stencil.timing import profiler
 
 def get_obj_with_attr(obj_list, attr_name):
     '''Get a ref to obj with attribute <attr_name> 
@@ -46,10 +47,20 @@ def apply_fill(obj_dict):
     for fl, ln in zip((get_attribute_refs(obj_dict.values(), "SetFillColor")), get_method_results(obj_dict.values(), "GetLineColor")):
         fl(ln)
 
-def normalise(obj_dict):
-    '''Normalise everything we can
+def normalise(obj_dict, arrays = None):
+    '''Normalise everything we can. Objects with bin arrays (by name) 
+       have their integrals done in one batch, and the arrays are scaled too
     '''
-    for sm, ing in zip((get_attribute_refs(obj_dict.values(), "Scale")), get_method_results(obj_dict.values(), "Integral")):
+    if arrays is None:
+        arrays = {}
+    names = [x for x in obj_dict if x in arrays]
+    ings  = bins.integrals([obj_dict[x] for x in names], [arrays[x] for x in names])
+    for nm, ing in zip(names, ings):
+        obj_dict[nm].Scale(1./float(ing))
+        arrays[nm].scale(1./float(ing))
+
+    others = [v for k, v in obj_dict.iteritems() if k not in arrays]
+    for sm, ing in zip((get_attribute_refs(others, "Scale")), get_method_results(others, "Integral")):
         sm(1./ing)
 
 def apply_line_style(obj_dict, line_style):
@@ -63,6 +74,30 @@ def remove_stats(obs):
     '''
     for method in get_attribute_refs(obs.values(), "SetStats"):
         method(ROOT.kFALSE)
+
+# what an object can do, and the method that tells us it can
+capability_methods = [("xaxis", "GetXaxis"), ("yaxis", "GetYaxis"),
+                      ("title", "SetTitle"), ("line", "SetLineColor"),
+                      ("line_style", "SetLineStyle"), ("fill", "SetFillColor"),
+                      ("stats", "SetStats"), ("scale", "Scale"),
+                      ("maximum", "SetMaximum"), ("get_maximum", "GetMaximum")]
+
+def classify(obj):
+    '''Work out once which capabilities an object has, so drawing doesn't
+       keep asking PyROOT. Histograms also get "bins"
+    '''
+    caps = set(cap for cap, method in capability_methods 
+               if callable(getattr(obj, method, None)))
+    if rio.is_histogram(obj):
+        caps.add("bins")
+    return frozenset(caps)
+
+def style_axis(axis, title, offset, size):
+    '''Title an axis
+    '''
+    axis.SetTitle(title)
+    axis.SetTitleOffset(offset)
+    axis.SetTitleSize(size)
                             
 
 class PlotOverlay(object):
@@ -74,14 +109,21 @@ class PlotOverlay(object):
                  log_y = False, add_fill = False, x_title = "xaxis", y_title = "yaxis",
                  title = "title", x_title_offset = 1., y_title_offset = 1., 
                  x_title_size = 0.04, y_title_size = 0.04, line_style = -1,
-                 normalise = False, no_stats=False
+                 normalise = False, no_stats=False, downsample = False, legend = None
                  ):
         '''Initilise with draw options. By default the legend is drawn, axes are scaled
-        to display all hists and the legend is drawn in the top right corner
+        to display all hists and the legend is drawn in the top right corner. 
+        downsample merges the bins of 1D and 2D histograms down to the canvas 
+        size in pixels as they are added. A canvas and (empty) legend can be 
+        given to reuse, see RenderContext
         '''
+        if legend is None:
+            legend = ROOT.TLegend(*leg_pos)
         self.obs              = {}
         self.draw_opts        = {}
-        self.legend           = ROOT.TLegend(*leg_pos)
+        self.bins             = {}
+        self.caps             = {}
+        self.legend           = legend
         self.no_legend        = no_legend
         self.canvas           = canvas
         self.auto_scale_x     = auto_scale_x
@@ -97,6 +139,7 @@ class PlotOverlay(object):
         self.y_title_offset   = y_title_offset
         self.normalise        = normalise
         self.no_stats         = no_stats
+        self.downsample       = downsample
         self.x_title_size   = x_title_size
         self.y_title_size   = y_title_size
         if line_style == -1:
@@ -118,148 +161,211 @@ class PlotOverlay(object):
         if leg_name is None:
             leg_name = name
         self.obs[name] = obj
+        self.caps[name] = classify(obj)
+        self.bins.pop(name, None)
+        if self.downsample and "bins" in self.caps[name]:
+            self.bins[name] = self.shrink(obj)
         self.legend.AddEntry(obj, leg_name, leg_opt)
         self.draw_opts[name] = draw_opt
 
     def add_stack(self, stack, name):
         '''Add a hist stack object. It has its own colors, and several entries for the legend
         '''
+        if self.downsample:
+            for hist in stack.hists.values():
+                self.shrink(hist)
         stack.build()
         self.obs[name] = stack.thstack
+        self.caps[name] = classify(stack.thstack)
+        self.bins.pop(name, None)
         self.draw_opts[name] = ""
         # now add all the internal histograms to the legend
         for n, h, o in zip(stack.leg_names.values(), stack.hists.values(), stack.leg_options.values()):
             self.legend.AddEntry(h, n, o)
 
+    def resolution(self):
+        '''How many pixels across and up the canvas (or pad) has
+        '''
+        return (max(int(self.canvas.GetWw() * self.canvas.GetAbsWNDC()), 1),
+                max(int(self.canvas.GetWh() * self.canvas.GetAbsHNDC()), 1))
+
+    def shrink(self, hist):
+        '''Merge the bins of hist, in place, to no more than the canvas (or
+           pad) can show. Returns its bin arrays
+        '''
+        arrays = bins.BinArrays(hist)
+        if arrays.dim < 3 and bins.downsample(arrays, self.resolution()):
+            bins.refill(hist, arrays)
+        return arrays
+
+    def with_cap(self, cap):
+        '''The objects with capability cap, from the table made as they were added
+        '''
+        return [self.obs[k] for k, caps in self.caps.iteritems() if cap in caps]
+
     def set_titles(self):
         '''Set the title for everything with a title
         '''
-        for x in get_attribute_refs(self.obs.values(), "SetTitle"):
-            x(self.title)
+        for x in self.with_cap("title"):
+            x.SetTitle(self.title)
 
     def set_x_titles(self):
         '''Set the x title for everything with x axis
         '''
-        for x in get_method_results(self.obs.values(), "GetXaxis"):
-            x.SetTitle(self.x_title)
-            x.SetTitleOffset(self.x_title_offset)
-            x.SetTitleSize(self.x_title_size)
+        for x in self.with_cap("xaxis"):
+            style_axis(x.GetXaxis(), self.x_title, self.x_title_offset, self.x_title_size)
 
     def set_y_titles(self):
         '''Set the y title for everything with x axis
         '''
-        for y in get_method_results(self.obs.values(), "GetYaxis"):
-            y.SetTitle(self.y_title)
-            y.SetTitleOffset(self.y_title_offset)
-            y.SetTitleSize(self.y_title_size)
+        for y in self.with_cap("yaxis"):
+            style_axis(y.GetYaxis(), self.y_title, self.y_title_offset, self.y_title_size)
 
     def set_x_range(self, low, high):
         '''Set the x-axis range of all relevant objects at once
         '''
-        for x in get_method_results(self.obs.values(), "GetXaxis"):
-            x.SetRangeUser(low, high)
+        for x in self.with_cap("xaxis"):
+            x.GetXaxis().SetRangeUser(low, high)
 
     def set_y_range(self, low, high):
         '''Set the y-axis range of all relevant objects at once,
            don't do this if we are already setting to maximum
         '''
         if not self.auto_range_maxima:
-            for x in get_method_results(self.obs.values(), "GetYaxis"):
-                x.SetRangeUser(low, high)
+            for x in self.with_cap("yaxis"):
+                x.GetYaxis().SetRangeUser(low, high)
 
     def set_maxima(self, set_max):
         '''Set the maximum on any object with that option
         '''
-        for x in get_attribute_refs(self.obs.values(), "SetMaximum"):
-            x(set_max)
+        for x in self.with_cap("maximum"):
+            x.SetMaximum(set_max)
+
+    def split_obs(self):
+        '''The histograms with their bin arrays (read once, then cached), and
+           the objects that don't have bins
+        '''
+        names = [k for k, caps in self.caps.iteritems() if "bins" in caps]
+        for nm in names:
+            if nm not in self.bins:
+                self.bins[nm] = bins.BinArrays(self.obs[nm])
+        others = [self.obs[k] for k, caps in self.caps.iteritems() if "bins" not in caps]
+        return [self.obs[x] for x in names], [self.bins[x] for x in names], others
+
+    def axis_extents(self, axis_index, cap):
+        '''Furthest extents of the x or y axis (axis_index 0 or 1, cap "xaxis"
+           or "yaxis") over everything with one. None if nothing has that axis
+        '''
+        hists, arrays = self.split_obs()[:2]
+        found = []
+        if hists:
+            found.append(bins.extents(hists, arrays, axis_index))
+        getter = dict(capability_methods)[cap]
+        for k, caps in self.caps.iteritems():
+            if "bins" in caps or cap not in caps:
+                continue
+            axis = getattr(self.obs[k], getter)()
+            found.append((axis.GetBinLowEdge(axis.GetFirst()), 
+                          axis.GetBinUpEdge(axis.GetLast())))
+        if not found:
+            return None
+        return min(x[0] for x in found), max(x[1] for x in found)
 
     def auto_range_x(self):
         '''Adjust everything with an xaxis to have the same scale
         '''
-        # work out the furthest extents of any of the x-axes
-        overall_max = None
-        overall_min = None
-
-        for xaxis in get_method_results(self.obs.values(), "GetXaxis"):
-            this_min = xaxis.GetBinLowEdge(xaxis.GetFirst())
-            this_max = xaxis.GetBinUpEdge(xaxis.GetLast())
-
-            if overall_max is None:
-                overall_max = this_max
-                overall_min = this_min
-            else:
-                overall_max = max(overall_max, this_max)
-                overall_min = min(overall_min, this_min)
-        
-        if overall_max is not None:
-            self.set_x_range(overall_min, overall_max)
+        extent = self.axis_extents(0, "xaxis")
+        if extent is not None:
+            self.set_x_range(*extent)
 
     def auto_range_y(self):
         '''Adjust everything with an yaxis to have the same scale
         '''
-        # work out the furthest extents of any of the y-axes
-        overall_max = None
-        overall_min = None
-        for obj in self.obs.values():
-            for yaxis in get_method_results(self.obs.values(), "GetYaxis"):
-                this_min = yaxis.GetBinLowEdge(yaxis.GetFirst())
-                this_max = yaxis.GetBinUpEdge(yaxis.GetLast())
-
-                if overall_max is None:
-                    overall_max = this_max
-                    overall_min = this_min
-                else:
-                    overall_max = max(overall_max, this_max)
-                    overall_min = min(overall_min, this_min)
-
-        if overall_max is not None:
-            self.set_y_range(overall_min, overall_max)
+        extent = self.axis_extents(1, "yaxis")
+        if extent is not None:
+            self.set_y_range(*extent)
+
+    def common_maximum(self):
+        '''The largest maximum of any object, None if nothing has one
+        '''
+        hists, arrays = self.split_obs()[:2]
+        maxes = list(bins.maxima(hists, arrays))
+        maxes += [self.obs[k].GetMaximum() for k, caps in self.caps.iteritems()
+                  if "bins" not in caps and "get_maximum" in caps]
+        if maxes == []:
+            return None
+        return max(maxes)
 
     def auto_range_maxima(self):
         '''Adjust everything to have the same maxima
         '''
-        maxes = get_method_results(self.obs.values(), "GetMaximum")
-        if maxes != []:
-            self.set_maxima(max(maxes))
+        set_max = self.common_maximum()
+        if set_max is not None:
+            self.set_maxima(set_max)
+
+    def style_all(self, set_max = None):
+        '''One pass over the capability table setting the maximum, titles,
+           colors, fill, line style and stats box of every object
+        '''
+        backup_list = color.backup_list
+        backup_count = 0
+        for name, caps in self.caps.iteritems():
+            obj = self.obs[name]
+            if set_max is not None and "maximum" in caps:
+                obj.SetMaximum(set_max)
+            if "xaxis" in caps:
+                style_axis(obj.GetXaxis(), self.x_title, self.x_title_offset, self.x_title_size)
+            if "yaxis" in caps:
+                style_axis(obj.GetYaxis(), self.y_title, self.y_title_offset, self.y_title_size)
+            if "title" in caps:
+                obj.SetTitle(self.title)
+
+            if "line" in caps and self.color_scheme is not None:
+                try:
+                    obj.SetLineColor(self.color_scheme[name])
+                except KeyError:
+                    # no color for this name
+                    obj.SetLineColor(backup_list[backup_count % len(backup_list)])
+                    backup_count += 1
+            if self.add_fill is True and "fill" in caps and "line" in caps:
+                obj.SetFillColor(obj.GetLineColor())
+            if self.line_style is not None and "line_style" in caps:
+                obj.SetLineStyle(self.line_style)
+            if self.no_stats is True and "stats" in caps:
+                obj.SetStats(ROOT.kFALSE)
 
-        
     def draw(self):
         '''Draw the objects on a copy of the canvas, 
            and return it to caller
         '''
+        with profiler.stage("draw"):
+            return self.draw_all()
+
+    def draw_all(self):
+        '''Does the work for draw
+        '''
         self.canvas.Clear()
         self.canvas.cd()
 
-        # ROOT seg faults if you dont draw them without "SAME first", so one of these is 
-        # drawn twice...
-        for k, v in self.obs.iteritems():
-            v.Draw(self.draw_opts[k])
-
-        for k, v in self.obs.iteritems():
-            v.Draw("SAME" + self.draw_opts[k])
-
+        # ROOT seg faults if the first object is drawn with "SAME", the rest
+        # are overlaid on it
+        for i, (k, v) in enumerate(self.obs.iteritems()):
+            if i == 0:
+                v.Draw(self.draw_opts[k])
+            else:
+                v.Draw("SAME" + self.draw_opts[k])
 
         if self.auto_scale_x:
             self.auto_range_x()
         if self.auto_scale_y:
             self.auto_range_y()
+        set_max = None
         if self.auto_scale_max:
-            self.auto_range_maxima()
+            set_max = self.common_maximum()
 
-        self.set_x_titles()
-        self.set_y_titles()
-        self.set_titles()
+        self.style_all(set_max)
         if not self.no_legend:
             self.legend.Draw("same")    
-        
-        if self.color_scheme is not None:
-            apply_color_scheme(self.obs, self.color_scheme)
-
-        if self.add_fill is True:
-            apply_fill(self.obs)
-            
-        if self.line_style is not None:
-            apply_line_style(self.obs, self.line_style)
 
         if self.log_x is True:
             self.canvas.SetLogx()
@@ -267,16 +373,95 @@ class PlotOverlay(object):
             self.canvas.SetLogy()                    
             
         if self.normalise is True:
-            normalise(self.obs)
-
-        if self.no_stats is True:
-            remove_stats(self.obs)
+            self.split_obs()
+            normalise(self.obs, self.bins)
 
         self.canvas.Update()
         return self.canvas
 
 
 
+def take_ownership(ob):
+    '''Have python delete ob once nothing here refers to it. Objects read
+       from files and detached would otherwise live until exit
+    '''
+    ROOT.SetOwnership(ob, True)
+
+class RenderContext(object):
+    '''Canvases and legends reused from plot to plot, so a long run doesn't
+       pile up ROOT objects (and the lists ROOT searches by name). Make each
+       PlotOverlay with overlay() and hand it back with release() once it's
+       written out
+    '''
+    def __init__(self):
+        '''Nothing is made until it's needed
+        '''
+        self.canvases   = []
+        self.legends    = []
+        self.n_canvases = 0
+        # every canvas made here, only these go back in the pool
+        self.made       = []
+
+    def take_canvas(self):
+        '''A free canvas, or a new one
+        '''
+        if self.canvases:
+            return self.canvases.pop()
+        self.n_canvases += 1
+        name = "stencil_canvas_{0}".format(self.n_canvases)
+        canvas = ROOT.TCanvas(name, name)
+        self.made.append(canvas)
+        return canvas
+
+    def take_legend(self, leg_pos):
+        '''A free legend moved to leg_pos, or a new one
+        '''
+        if not self.legends:
+            return ROOT.TLegend(*leg_pos)
+        legend = self.legends.pop()
+        legend.SetX1NDC(leg_pos[0])
+        legend.SetY1NDC(leg_pos[1])
+        legend.SetX2NDC(leg_pos[2])
+        legend.SetY2NDC(leg_pos[3])
+        return legend
+
+    def overlay(self, **options):
+        '''A PlotOverlay with the given constructor options, drawn on a 
+           pooled canvas with a pooled legend. A canvas given in the options
+           (e.g. a paint.MultiPage's) is used instead, and isn't pooled
+        '''
+        leg_pos = options.get("leg_pos", (0.7, 0.7, 0.9, 0.9))
+        canvas = options.get("canvas")
+        if canvas is None:
+            canvas = self.take_canvas()
+        return PlotOverlay(**dict(options, canvas = canvas,
+                                  legend = self.take_legend(leg_pos)))
+
+    def release(self, overlay):
+        '''Take back the canvas and legend of an overlay from overlay(), 
+           cleared, and let go of what it drew: stacks and the histograms in
+           them, and every other object, are deleted once the caller drops 
+           them too. The overlay can't be used again
+        '''
+        canvas, legend = overlay.canvas, overlay.legend
+        canvas.Clear()
+        canvas.SetLogx(0)
+        canvas.SetLogy(0)
+        legend.Clear()
+        for ob in overlay.obs.values():
+            if ob.InheritsFrom("THStack") and ob.GetHists():
+                for hist in ob.GetHists():
+                    take_ownership(hist)
+            take_ownership(ob)
+        overlay.obs.clear()
+        overlay.bins.clear()
+        overlay.caps.clear()
+        overlay.canvas = overlay.legend = None
+        if any(canvas is x for x in self.made):
+            self.canvases.append(canvas)
+        self.legends.append(legend)
+
+
 class HistStack(object):
     '''Class for overlaying histograms into THStacks
     '''
@@ -316,6 +501,12 @@ class HistStack(object):
     def build(self):
         '''Piece it together
         '''
+        with profiler.stage("build_stack"):
+            return self.build_all()
+
+    def build_all(self):
+        '''Does the work for build
+        '''
         self.thstack = ROOT.THStack()
         if self.color_scheme is not None:
             apply_color_scheme(self.hists, self.color_scheme)
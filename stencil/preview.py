@@ -0,0 +1,76 @@
+'''Contact sheets: a quick look at every key in a file, or every key some
+   files share, as many small PlotOverlays to a page in a grid of pads.
+   Pages are written as numbered PNGs or as one multi-page PDF/PS, with a
+   JSON index of which keys are on which page
+'''
+import json
+import os
+from stencil.lazy import ROOT
+import stencil.rio as rio
+import stencil.plot as plt
+import stencil.paint as paint
+from stencil.timing import profiler
+
+def page_name(outfile, page):
+    '''The file for page (counting from 1) of an image sheet, e.g. sheet_3.png
+    '''
+    base, ext = os.path.splitext(outfile)
+    return "{0}_{1}{2}".format(base, page, ext)
+
+def draw_page(canvas, grid, keys, filenames, names, options, session):
+    '''Overlay each key from every file in its own pad of canvas. Returns 
+       the overlays, which have to live until the page is written
+    '''
+    canvas.Clear()
+    canvas.Divide(*grid)
+    overlays = []
+    for i, key in enumerate(keys):
+        po = plt.PlotOverlay(**dict(options, canvas = canvas.cd(i + 1), title = key,
+                                    downsample = True))
+        for filename, name in zip(filenames, names):
+            po.add_obj(session.grab_obj(filename, key), name)
+        po.draw()
+        overlays.append(po)
+    canvas.Update()
+    return overlays
+
+def contact_sheets(filenames, outfile, options, names = None, grid = (4, 4),
+                   size = (1600, 1200), session = None):
+    '''Lay out the keys filenames share, grid (columns, rows) to a page on a
+       canvas of size pixels. options are the PlotOverlay constructor options,
+       each plot is downsampled to its pad and titled with its key. names
+       label each file in the legends. Returns the index {page : [keys]}
+    '''
+    session = rio.get_session(session)
+    if names is None:
+        names = [os.path.basename(x) for x in filenames]
+    keys = session.common_keys(filenames)
+    per_page = grid[0] * grid[1]
+    canvas = ROOT.TCanvas("contact_sheet", "contact_sheet", *size)
+
+    document = None
+    if os.path.splitext(outfile)[1] in (".pdf", ".ps"):
+        document = paint.MultiPage(outfile, canvas)
+    index = {}
+    for start in range(0, len(keys), per_page):
+        page = start // per_page + 1
+        on_page = keys[start:start + per_page]
+        with profiler.for_plot("page {0}".format(page)):
+            overlays = draw_page(canvas, grid, on_page, filenames, names, options, session)
+            if document is not None:
+                document.add(canvas, on_page, "{0} - {1}".format(on_page[0], on_page[-1]))
+            else:
+                with profiler.stage("save_as"):
+                    canvas.SaveAs(page_name(outfile, page))
+                index[str(page)] = on_page
+        # the objects read for this page go once the overlays do
+        for po in overlays:
+            for ob in po.obs.values():
+                plt.take_ownership(ob)
+        del overlays
+
+    if document is not None:
+        return document.close()
+    with open(os.path.splitext(outfile)[0] + ".json", "w") as f:
+        json.dump(index, f, indent = 1, sort_keys = True)
+    return index
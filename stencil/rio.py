@@ -1,24 +1,167 @@
-'''Functions for manipulating ROOT files with a filename only interface
+'''Functions for manipulating ROOT files with a filename only interface.
+   A snapshot directory (see export_snapshot) can stand in for a ROOT file
 '''
 
-import ROOT
+from stencil.lazy import ROOT
+from stencil.timing import profiler
+import stencil.bins as bins
+import numpy as np
+import multiprocessing
+import json
 import re
+import os
+from collections import OrderedDict
 
-def get_keys(filename):
+def file_stamp(filename):
+    '''Modification time of filename, or None if it isn't a local file
+       (e.g. an xrootd url)
+    '''
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+class RootSession(object):
+    '''Lists the keys of each file once, indexes which files hold which key
+       and keeps at most max_open TFiles open at a time, closing the least
+       recently used first. A listing is redone if the file changes on disk.
+       Snapshots are opened and listed the same way
+    '''
+    def __init__(self, max_open = 16):
+        '''Nothing is opened until asked for
+        '''
+        self.max_open = max_open
+        self.files    = OrderedDict()
+        self.listings = {}
+        self.index    = {}
+
+    def open(self, filename):
+        '''Get an open TFile (or Snapshot) for filename, reusing the handle 
+           if we have one
+        '''
+        try:
+            rt_f = self.files.pop(filename)
+        except KeyError:
+            with profiler.stage("open"):
+                if is_snapshot(filename):
+                    rt_f = Snapshot(filename)
+                else:
+                    rt_f = ROOT.TFile(filename)
+            while len(self.files) >= self.max_open:
+                self.files.popitem(last = False)[1].Close()
+        self.files[filename] = rt_f
+        return rt_f
+
+    def keep_open(self, n_files):
+        '''Make room for at least n_files open at once, for readers that go
+           round the same files key by key and would otherwise reopen each
+           file for every key
+        '''
+        self.max_open = max(self.max_open, n_files)
+
+    def close(self, filename = None):
+        '''Close one file, or all of them if no filename given
+        '''
+        if filename is None:
+            for rt_f in self.files.values():
+                rt_f.Close()
+            self.files.clear()
+        elif filename in self.files:
+            self.files.pop(filename).Close()
+
+    def forget(self, filename):
+        '''Drop the handle, key listing and index entries for filename
+        '''
+        self.close(filename)
+        for key in self.listings.pop(filename, (None, [], set()))[2]:
+            self.index[key].discard(filename)
+            if not self.index[key]:
+                del self.index[key]
+
+    def get_keys(self, filename):
+        '''All the object names in filename, listed once per version of the file
+        '''
+        stamp = file_stamp(filename)
+        if filename in self.listings:
+            if self.listings[filename][0] == stamp:
+                return self.listings[filename][1]
+            self.forget(filename)
+
+        rt_f = self.open(filename)
+        with profiler.stage("list_keys"):
+            if isinstance(rt_f, Snapshot):
+                keys = rt_f.keys()
+            else:
+                keys = [x.GetName() for x in rt_f.GetListOfKeys()]
+        self.listings[filename] = (stamp, keys, set(keys))
+        for key in keys:
+            self.index.setdefault(key, set()).add(filename)
+        return keys
+
+    def key_set(self, filename):
+        '''The object names in filename as a set
+        '''
+        self.get_keys(filename)
+        return self.listings[filename][2]
+
+    def has_key(self, filename, key_name):
+        '''Is there a key with name key_name in filename?
+        '''
+        self.get_keys(filename)
+        return filename in self.index.get(key_name, ())
+
+    def common_keys(self, filenames):
+        '''Names present in every file, in the order of the first file
+        '''
+        self.keep_open(len(filenames))
+        shared = set.intersection(*[self.key_set(fn) for fn in filenames])
+        return [x for x in self.get_keys(filenames[0]) if x in shared]
+
+    def grab_obj(self, filename, obj_name = None):
+        '''Grab an object by name, or the first object in the file.
+           Histograms are detached from the file and owned by python, so
+           they're deleted once nothing here refers to them
+        '''
+        keys = self.get_keys(filename)
+        if obj_name is None:
+            obj_name = keys[0]
+        rt_f = self.open(filename)
+        with profiler.stage("read"):
+            ob = rt_f.Get(obj_name)
+            if is_histogram(ob):
+                ob.SetDirectory(0)
+                ROOT.SetOwnership(ob, True)
+        return ob
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+default_session = RootSession()
+
+def get_session(session = None):
+    '''The session to use when a caller doesn't bring their own
+    '''
+    if session is None:
+        return default_session
+    return session
+
+def get_keys(filename, session = None):
     '''Get all the object names in filename
     '''
-    rt_f = ROOT.TFile(filename)
-    return [x.GetName() for x in rt_f.GetListOfKeys()]
+    return list(get_session(session).get_keys(filename))
 
-def has_key(filename, key_name):
+def has_key(filename, key_name, session = None):
     '''Is there a key with name key_name in filename1?
     '''
-    return key_name in get_keys(filename)
+    return get_session(session).has_key(filename, key_name)
 
-def all_have_key(filenames, key_name):
+def all_have_key(filenames, key_name, session = None):
     '''Is there a key named key_name in every file in the list
     '''
-    return all(has_key(x, key_name) for x in filenames)
+    return all(has_key(x, key_name, session) for x in filenames)
 
 def is_histogram(obj):
     '''Is this object a ROOT histogram? Test the class name against regex
@@ -26,44 +169,352 @@ def is_histogram(obj):
     cls_name = obj.__class__.__name__
     return re.match("^TH[0-3][CSIFD]$", cls_name) is not None
 
-def grab_obj(filename, obj_name = None):
+def grab_obj(filename, obj_name = None, session = None):
     '''Grab an object by name, or the first object in a ROOT file
     '''
-    f  = ROOT.TFile(filename)
-    if obj_name is not None:
-        ob = f.Get(obj_name)
-    else:
-        ob = f.Get(f.GetListOfKeys()[0].GetName())
-    if is_histogram(ob):
-        ob.SetDirectory(0)
-    return ob
+    return get_session(session).grab_obj(filename, obj_name)
+
 
+def iter_obs(filename, session = None):
+    '''Yield the objects inside root file one at a time. Nothing is kept
+       here once the consumer moves on
+    '''
+    session = get_session(session)
+    for key in list(session.get_keys(filename)):
+        yield session.grab_obj(filename, key)
 
-def grab_all_obs(filename):
+def grab_all_obs(filename, session = None):
     '''Grab all the objects inside root file as python list
     '''
-    f = ROOT.TFile(filename)
-    obs = [f.Get(key) for key in get_keys(filename)]
-    for ob in obs:
-        if is_histogram(ob):
-            ob.SetDirectory(0)
-    return obs
+    return list(iter_obs(filename, session))
 
-def contains_only_hists(filename):
+def contains_only_hists(filename, session = None):
     '''Does the file contain only histograms?
     '''
-    return all([is_histogram(x) for x in grab_all_obs(filename)])
+    return all(is_histogram(x) for x in iter_obs(filename, session))
+
+def iter_zip(filenames, session = None):
+    '''Yield lists of the i-th object from each file, one list at a time,
+       stopping at the end of the shortest file
+    '''
+    session = get_session(session)
+    session.keep_open(len(filenames))
+    its = [iter_obs(x, session) for x in filenames]
+    while True:
+        try:
+            row = [next(x) for x in its]
+        except StopIteration:
+            return
+        yield row
 
-def zip_files(filenames):
+def zip_files(filenames, session = None):
     '''Zip together the objects in filenames into list of lists
     '''
-    obs_list = [grab_all_obs(x) for x in filenames]
-    common_len = min(obs_list)
-    return [[x[i] for x in obs_list ] for i in xrange(common_len)]
+    return list(iter_zip(filenames, session))
+
+def get_common_keys(filenames, session = None):
+    '''Names of the objects found in every file, in the order of the first
+    '''
+    return get_session(session).common_keys(filenames)
+
+def iter_common_obs(filenames, session = None):
+    '''Yield lists of the objects with the same name in every file, one 
+       name at a time
+    '''
+    session = get_session(session)
+    # common_keys makes room for every file
+    for kn in session.common_keys(filenames):
+        yield [session.grab_obj(fn, kn) for fn in filenames]
 
-def get_common_obs(filenames):
+def get_common_obs(filenames, session = None):
     '''Zip together all the objects in filename list with same name
-    '''    
-    shared_keys = get_keys(filenames[0])
-    shared_keys = [x for x in shared_keys if all_have_key(filenames, x)]
-    return [[grab_obj(fn, kn) for fn in filenames] for kn in shared_keys]
+    '''
+    return list(iter_common_obs(filenames, session))
+
+def init_reader():
+    '''Reader processes get their own file handles, not the parent's
+    '''
+    global default_session
+    ROOT.gROOT.SetBatch(True)
+    default_session = RootSession()
+
+def read_file(file_and_names, session = None):
+    '''Read the objects named (None for the first) from one file. Returns 
+       {name : object}, the names it doesn't have and the profiler records 
+       made, to send back from a reader process
+    '''
+    filename, obj_names = file_and_names
+    session = get_session(session)
+    mark = len(profiler.records)
+    found = {}
+    try:
+        keys = session.key_set(filename)
+    except Exception:
+        # can't be opened, so has nothing
+        return found, list(obj_names), profiler.take(mark)
+    for name in obj_names:
+        if name is None or name in keys:
+            found[name] = session.grab_obj(filename, name)
+    session.close(filename)
+    missing = [x for x in obj_names if x not in found]
+    return found, missing, profiler.take(mark)
+
+def prefetch(requests, n_jobs = 4, session = None):
+    '''Read a list of (filename, object name) pairs, opening and decompressing
+       up to n_jobs files at once in reader processes. Returns the objects in
+       the order asked for (None where missing), histograms detached, and 
+       {filename : [names it doesn't have]}
+    '''
+    by_file = OrderedDict()
+    for filename, name in requests:
+        by_file.setdefault(filename, [])
+        if name not in by_file[filename]:
+            by_file[filename].append(name)
+
+    n_jobs = min(n_jobs, len(by_file))
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, init_reader)
+        try:
+            results = pool.map(read_file, by_file.items(), chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [read_file(x, session) for x in by_file.items()]
+
+    found   = {}
+    missing = OrderedDict()
+    for filename, (obs, not_there, timings) in zip(by_file, results):
+        profiler.records.extend(timings)
+        for name, ob in obs.iteritems():
+            if is_histogram(ob):
+                ob.SetDirectory(0)
+            found[(filename, name)] = ob
+        if not_there:
+            missing[filename] = not_there
+    return [found.get(tuple(x)) for x in requests], missing
+
+def sum_files(filenames_and_name, session = None):
+    '''Sum the bin arrays of one histogram over a run of files, e.g. in a
+       reader process. Returns the sum, the total entries and the profiler records
+    '''
+    filenames, obj_name = filenames_and_name
+    session = get_session(session)
+    mark = len(profiler.records)
+    total = None
+    entries = 0.
+    for filename in filenames:
+        hist = session.grab_obj(filename, obj_name)
+        if not hist or not is_histogram(hist):
+            raise KeyError("no histogram {0} in {1}".format(obj_name, filename))
+        arrays = bins.BinArrays(hist)
+        entries += hist.GetEntries()
+        # the arrays are all we need from here on
+        del hist
+        session.close(filename)
+        if total is None:
+            total = arrays
+        elif not bins.same_binning(total, arrays):
+            raise ValueError("{0} in {1} is binned differently to {2}".format(
+                obj_name, filename, filenames[0]))
+        else:
+            # a running sum, so only two histograms are held at once
+            with profiler.stage("merge"):
+                total = bins.add(total, arrays)
+    return total, entries, profiler.take(mark)
+
+def chunks(items, n_chunks):
+    '''Split items into at most n_chunks runs of near equal length
+    '''
+    if not items:
+        raise ValueError("nothing to split into chunks")
+    n_chunks = max(min(n_chunks, len(items)), 1)
+    size = -(-len(items) // n_chunks)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def merge_groups(file_groups, obj_name = None, n_jobs = 4, session = None):
+    '''Sum histogram obj_name (or each file's first object) over each list
+       of files in file_groups, without writing anything out. Each group is
+       split into runs summed in up to n_jobs reader processes, then the runs
+       are added pairwise. Binning must match exactly. Returns one detached
+       histogram per group, a copy of the group's first with the sum in it
+    '''
+    tasks = []
+    for i, filenames in enumerate(file_groups):
+        if not filenames:
+            raise ValueError("no files to merge in group {0}".format(i))
+        tasks += [(i, (run, obj_name)) for run in chunks(list(filenames), n_jobs)]
+
+    if n_jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(n_jobs, len(tasks)), init_reader)
+        try:
+            results = pool.map(sum_files, [x[1] for x in tasks], chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [sum_files(x[1], session) for x in tasks]
+
+    merged = []
+    for i, filenames in enumerate(file_groups):
+        done = [res for (group, task), res in zip(tasks, results) if group == i]
+        for total, entries, timings in done:
+            profiler.records.extend(timings)
+        hist = get_session(session).grab_obj(filenames[0], obj_name)
+        with profiler.stage("merge"):
+            bins.fill(hist, bins.tree_sum([x[0] for x in done]))
+        hist.SetEntries(sum(x[1] for x in done))
+        merged.append(hist)
+    return merged
+
+def merge(filenames, obj_name = None, n_jobs = 4, session = None):
+    '''Sum histogram obj_name over filenames, see merge_groups
+    '''
+    return merge_groups([filenames], obj_name, n_jobs, session)[0]
+
+# Snapshots: the histograms of a file as flat float64 columns, read back
+# through memory maps so repeat runs skip decompression and every worker
+# shares the one page cache copy. A directory holding
+#
+#   contents.f8, errors.f8, edges.f8 - every histogram's arrays end to end
+#   index.json - {"source" : <file>, "skipped" : [<non histogram keys>],
+#                 "hists" : [{"name", "class", "title", "dim", "shape",
+#                             "entries", "sumw2", "offset", "axes" :
+#                             [{"title", "uniform", "offset", "n_edges"}]}]}
+#
+# index.json is written last, so a snapshot without one isn't finished
+
+snapshot_columns = ("contents", "errors", "edges")
+
+def is_snapshot(filename):
+    '''Is filename a snapshot directory?
+    '''
+    return os.path.isfile(os.path.join(filename, "index.json"))
+
+def snapshot_entry(key, hist, arrays, offsets):
+    '''Index entry for the histogram under key, whose arrays go at offsets
+       (elements into each column). Moves offsets on past them
+    '''
+    axes = []
+    for axis, edges in zip(bins.get_axes(hist), arrays.edges):
+        axes.append({"title"   : axis.GetTitle(),
+                     "uniform" : axis.GetXbins().GetSize() == 0,
+                     "offset"  : offsets["edges"],
+                     "n_edges" : len(edges)})
+        offsets["edges"] += len(edges)
+    entry = {"name"    : key,
+             "class"   : hist.ClassName(),
+             "title"   : hist.GetTitle(),
+             "dim"     : arrays.dim,
+             "shape"   : list(arrays.shape),
+             "entries" : hist.GetEntries(),
+             "sumw2"   : hist.GetSumw2N() > 0,
+             "offset"  : offsets["contents"],
+             "axes"    : axes}
+    offsets["contents"] += arrays.contents.size
+    return entry
+
+def export_snapshot(filename, snap_dir, session = None):
+    '''Write every histogram in filename to a snapshot in snap_dir, one 
+       at a time. Returns the index. Anything else in the file is skipped
+    '''
+    session = get_session(session)
+    if not os.path.isdir(snap_dir):
+        os.makedirs(snap_dir)
+    index = {"source" : os.path.abspath(filename), "hists" : [], "skipped" : []}
+    offsets = {"contents" : 0, "edges" : 0}
+    paths = dict((x, os.path.join(snap_dir, x + ".f8")) for x in snapshot_columns)
+
+    with profiler.stage("snapshot"):
+        outs = dict((x, open(paths[x] + ".tmp", "wb")) for x in snapshot_columns)
+        try:
+            for key in session.get_keys(filename):
+                ob = session.grab_obj(filename, key)
+                if not is_histogram(ob):
+                    index["skipped"].append(key)
+                    continue
+                arrays = bins.BinArrays(ob)
+                index["hists"].append(snapshot_entry(key, ob, arrays, offsets))
+                arrays.contents.tofile(outs["contents"])
+                arrays.errors.tofile(outs["errors"])
+                for edges in arrays.edges:
+                    edges.tofile(outs["edges"])
+                # only one histogram is held at a time
+                del ob, arrays
+        finally:
+            for out in outs.values():
+                out.close()
+        for path in paths.values():
+            os.rename(path + ".tmp", path)
+        with open(os.path.join(snap_dir, "index.json.tmp"), "w") as f:
+            json.dump(index, f, indent = 1)
+        os.rename(os.path.join(snap_dir, "index.json.tmp"), os.path.join(snap_dir, "index.json"))
+    return index
+
+def map_column(path):
+    '''Read only memory map of a column, numpy can't map an empty file
+    '''
+    if os.path.getsize(path) == 0:
+        return np.empty(0)
+    return np.memmap(path, dtype = np.float64, mode = "r")
+
+class Snapshot(object):
+    '''A snapshot opened for reading. Looks enough like a TFile for 
+       RootSession: histograms come back from Get, rebuilt from the maps
+    '''
+    def __init__(self, snap_dir):
+        '''Map the columns, nothing is read until it's asked for
+        '''
+        with open(os.path.join(snap_dir, "index.json")) as f:
+            self.index = json.load(f)
+        self.entries = OrderedDict((x["name"], x) for x in self.index["hists"])
+        self.columns = dict((x, map_column(os.path.join(snap_dir, x + ".f8")))
+                            for x in snapshot_columns)
+
+    def keys(self):
+        '''Names of the histograms, in the order of the original file
+        '''
+        return list(self.entries)
+
+    def arrays(self, name):
+        '''Bin arrays for histogram name, as read only views of the maps
+        '''
+        entry = self.entries[name]
+        size  = int(np.prod(entry["shape"]))
+        cut   = slice(entry["offset"], entry["offset"] + size)
+        edges = [self.columns["edges"][x["offset"]:x["offset"] + x["n_edges"]]
+                 for x in entry["axes"]]
+        return bins.from_columns(entry["dim"],
+                                 self.columns["contents"][cut].reshape(entry["shape"]),
+                                 self.columns["errors"][cut].reshape(entry["shape"]),
+                                 edges)
+
+    def Get(self, name):
+        '''Rebuild histogram name, None if there's no such histogram
+        '''
+        if name not in self.entries:
+            return None
+        entry  = self.entries[name]
+        arrays = self.arrays(name)
+        # ROOT only takes all uniform or all variable bins for every class
+        uniform = all(x["uniform"] for x in entry["axes"][:entry["dim"]])
+        shape_args = []
+        for edges in arrays.edges[:entry["dim"]]:
+            if uniform:
+                shape_args += [len(edges) - 1, edges[0], edges[-1]]
+            else:
+                shape_args += [len(edges) - 1, np.array(edges)]
+        hist = getattr(ROOT, str(entry["class"]))(str(name), str(entry["title"]), *shape_args)
+        hist.SetDirectory(0)
+        hist.SetContent(np.array(arrays.contents.ravel()))
+        if entry["sumw2"]:
+            hist.SetError(np.array(arrays.errors.ravel()))
+        hist.SetEntries(entry["entries"])
+        for axis, info in zip(bins.get_axes(hist), entry["axes"]):
+            axis.SetTitle(str(info["title"]))
+        return hist
+
+    def Close(self):
+        '''Let go of the maps
+        '''
+        self.columns = {}
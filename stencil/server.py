@@ -0,0 +1,137 @@
+'''A long running render server. Plot jobs (see stencil.jobs) arrive one JSON
+   object per line, on stdin or a local unix socket, and are drawn by a pool
+   of workers that keep ROOT, open files and color schemes warm between jobs.
+   Each job line gets one JSON reply line:
+
+    {"id" : <the job's "id", if it had one>, "ok" : true/false,
+     "outfiles" : [...], "failures" : [[what, traceback], ...]}
+'''
+import multiprocessing
+import threading
+import socket
+import json
+import sys
+import os
+import stencil.jobs as jobs
+import stencil.plot as plt
+import stencil.batch as batch
+from stencil.timing import profiler
+
+# canvases and legends each worker reuses from job to job
+context = plt.RenderContext()
+
+# jobs are expanded against the one shared default session, which isn't
+# safe to use from more than one connection thread at a time
+expand_lock = threading.Lock()
+
+def init_server_worker():
+    '''batch.init_worker, and send anything the worker (pdflatex, ROOT)
+       writes to stdout on to stderr, so it can't get into the replies
+       when they go out on stdout
+    '''
+    batch.init_worker()
+    sys.stdout.flush()
+    os.dup2(2, 1)
+
+def run_in_context(job):
+    '''jobs.run_job, reusing this process's canvases and legends
+    '''
+    return jobs.run_job(job, context = context)
+
+def run_safely(job):
+    '''Run one plot job in a worker, returns (outfile or None, error or None,
+       profiler records)
+    '''
+    result, err, timings = batch.call_safely((run_in_context, job))
+    if err is not None:
+        return None, err, timings
+    if result is None:
+        # straight from the cache
+        return jobs.describe(job), None, timings
+    return result[0], None, timings
+
+def make_reply(job, plots, outcomes):
+    '''Summarise the outcome of every plot a job was split into
+    '''
+    failures = [[jobs.describe(plot), err] for plot, (res, err, timings) 
+                in zip(plots, outcomes) if err is not None]
+    for res, err, timings in outcomes:
+        profiler.records.extend(timings)
+    return {"id"       : job.get("id"),
+            "ok"       : not failures,
+            "outfiles" : [res for res, err, timings in outcomes if res is not None],
+            "failures" : failures}
+
+def handle_line(pool, line, reply):
+    '''Start the plots for one job line, reply is called with the summary
+       once they're all done. Returns the pending result, None if the line
+       was no good
+    '''
+    try:
+        job = json.loads(line)
+        with expand_lock:
+            plots = jobs.expand(job)
+    except Exception as err:
+        reply({"id" : None, "ok" : False, "outfiles" : [],
+               "failures" : [["job", repr(err)]]})
+        return None
+    return pool.map_async(run_safely, plots, chunksize = 1,
+                          callback = lambda outcomes: reply(make_reply(job, plots, outcomes)))
+
+def serve_stream(pool, instream, outstream):
+    '''Take jobs from instream until it closes, replying on outstream as
+       each one finishes. Returns once every reply is written
+    '''
+    lock = threading.Lock()
+    def reply(msg):
+        with lock:
+            outstream.write(json.dumps(msg) + "\n")
+            outstream.flush()
+
+    pending = []
+    for line in iter(instream.readline, ""):
+        if line.strip():
+            pending.append(handle_line(pool, line, reply))
+    for result in pending:
+        if result is not None:
+            result.wait()
+
+def serve_connection(pool, conn):
+    '''Serve the jobs sent down one socket connection
+    '''
+    try:
+        serve_stream(pool, conn.makefile("r"), conn.makefile("w"))
+    finally:
+        conn.close()
+
+def serve_socket(pool, path):
+    '''Listen on a unix socket at path, each connection served in its own thread
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(64)
+    try:
+        while True:
+            conn = listener.accept()[0]
+            thread = threading.Thread(target = serve_connection, args = (pool, conn))
+            thread.daemon = True
+            thread.start()
+    finally:
+        listener.close()
+        os.remove(path)
+
+def serve(socket_path = "", n_jobs = 4, instream = None, outstream = None):
+    '''Run the server on socket_path, or on the streams if no path given
+    '''
+    # workers are made before anything here touches ROOT
+    pool = multiprocessing.Pool(n_jobs, init_server_worker)
+    try:
+        if socket_path:
+            serve_socket(pool, socket_path)
+        else:
+            serve_stream(pool, instream, outstream)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,112 @@
+'''Timing of each stage of the render pipeline (file reads, drawing, SaveAs,
+   the tex rewrite, pdflatex ...) for each plot. Off unless switched on, in
+   which case each stage records its wall time and, optionally, peak RSS.
+   A stage's time leaves out any stages run inside it
+'''
+from contextlib import contextmanager
+import resource
+import json
+import time
+import sys
+
+def peak_rss():
+    '''Peak resident memory so far in kB (as linux reports it) for this
+       process, and for the largest of its finished children (pdflatex)
+    '''
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+class Profiler(object):
+    '''Collects one record per stage run: the plot it was for, the stage
+       name, wall time and possibly peak RSS
+    '''
+    def __init__(self):
+        '''Starts switched off
+        '''
+        self.enabled   = False
+        self.track_rss = False
+        self.current   = None
+        self.records   = []
+        # time taken by the stages inside each stage that's running
+        self.inner     = []
+
+    def enable(self, track_rss = False):
+        '''Start recording
+        '''
+        self.enabled   = True
+        self.track_rss = track_rss
+
+    @contextmanager
+    def for_plot(self, name):
+        '''Stages inside this block are attributed to plot name
+        '''
+        outer = self.current
+        self.current = name
+        try:
+            yield
+        finally:
+            self.current = outer
+
+    @contextmanager
+    def stage(self, name):
+        '''Time the block as stage name. Time in stages opened inside the
+           block is theirs, not this one's, so nothing is counted twice
+        '''
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        self.inner.append(0.)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            inner = self.inner.pop()
+            if self.inner:
+                self.inner[-1] += elapsed
+            record = {"plot" : self.current, "stage" : name,
+                      "seconds" : elapsed - inner}
+            if self.track_rss:
+                record["peak_rss_kb"], record["children_peak_rss_kb"] = peak_rss()
+            self.records.append(record)
+
+    def take(self, mark):
+        '''Remove and return the records made since there were mark of them,
+           for sending from a worker back to its parent
+        '''
+        taken = self.records[mark:]
+        del self.records[mark:]
+        return taken
+
+    def totals(self, field):
+        '''Total time by plot or stage (field), slowest first
+        '''
+        totals = {}
+        for rec in self.records:
+            totals[rec[field]] = totals.get(rec[field], 0.) + rec["seconds"]
+        return sorted(totals.items(), key = lambda x: -x[1])
+
+    def summary(self, n_slowest = 10):
+        '''Human readable time per stage and the slowest plots
+        '''
+        lines = ["time by stage:"]
+        lines += ["  {0:<16} {1:10.3f} s".format(stage, secs)
+                  for stage, secs in self.totals("stage")]
+        lines.append("slowest plots:")
+        lines += ["  {0:<40} {1:10.3f} s".format(str(plot), secs)
+                  for plot, secs in self.totals("plot")[:n_slowest]]
+        return "\n".join(lines) + "\n"
+
+    def report(self, filename, stream = sys.stderr):
+        '''Write every record plus the totals to filename as JSON, and a
+           summary to stream. Does nothing unless profiling is on
+        '''
+        if not self.enabled:
+            return
+        with open(filename, "w") as f:
+            json.dump({"records" : self.records,
+                       "stages"  : self.totals("stage"),
+                       "plots"   : self.totals("plot")}, f, indent = 1)
+        stream.write(self.summary())
+
+profiler = Profiler()
@@ -0,0 +1,197 @@
+'''Keep the plots of a manifest (see stencil.manifest) up to date while the
+   input files are being rewritten. Each pass checks the file mtimes, and for
+   files that changed fingerprints the keys the plots use (stencil.cache).
+   Only plots with an input whose contents changed, or whose output has gone,
+   are drawn again, found through the map from each (file, key) to the
+   outputs drawn from it. What was drawn from what is kept in a JSON state
+   file
+
+    {"files"   : {<filename> : <mtime>},
+     "keys"    : {<filename> : {<key> : <fingerprint>}},
+     "outputs" : {<outfile>  : [[<filename>, <key>, <fingerprint>], ...]}}
+
+   so a restarted watch picks up where the last one left off
+'''
+import time
+import json
+import sys
+import os
+import stencil.rio as rio
+import stencil.jobs as jobs
+import stencil.cache as cache
+import stencil.manifest as manifest
+
+def load_state(filename):
+    '''The state saved by an earlier watch, or an empty one
+    '''
+    state = {"files" : {}, "keys" : {}, "outputs" : {}}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            state.update(json.load(f))
+    return state
+
+def save_state(state, filename):
+    '''Write the state out, atomically so a killed watch can't leave half of it
+    '''
+    tmp_name = filename + ".tmp"
+    with open(tmp_name, "w") as f:
+        json.dump(state, f, indent = 1, sort_keys = True)
+    os.rename(tmp_name, filename)
+
+def expected_outfile(plot):
+    '''Where a plot will be written, without reading its objects. Assumes
+       objects are named for their keys, as jobs.get_outfile does
+    '''
+    if plot.get("outfile"):
+        return plot["outfile"]
+    return "{0}{1}.{2}".format(plot.get("prefix", ""), plot["inputs"][0]["objname"],
+                               plot.get("ext", "png"))
+
+class Watcher(object):
+    '''Redraws the plots of a list of jobs whose inputs have changed
+    '''
+    def __init__(self, plot_jobs, state_file, n_jobs = 1, compiler = None, session = None):
+        '''The saved state is read from state_file, if there is one
+        '''
+        self.plot_jobs  = plot_jobs
+        self.state_file = state_file
+        self.n_jobs     = n_jobs
+        self.compiler   = compiler
+        self.session    = rio.get_session(session)
+        self.state      = load_state(state_file)
+        # the first pass looks at everything, later ones only run on a change
+        self.retry      = True
+
+    def dependents(self):
+        '''The saved map from each (file, key) to the outputs drawn from it,
+           as (outfile, fingerprint it was drawn from) pairs
+        '''
+        deps = {}
+        for outfile, inputs in self.state["outputs"].iteritems():
+            for filename, key, fprint in inputs:
+                deps.setdefault((filename, key), []).append((outfile, fprint))
+        return deps
+
+    def changed_outputs(self, found):
+        '''Outputs drawn from a (file, key) whose fingerprint is no longer
+           the one in found
+        '''
+        deps = self.dependents()
+        return set(outfile for needed, fprint in found.iteritems()
+                   for outfile, drawn_from in deps.get(needed, ()) if drawn_from != fprint)
+
+    def input_files(self):
+        '''Every file any job reads
+        '''
+        return sorted(set(x["filename"] for job in self.plot_jobs for x in job["inputs"]))
+
+    def plan(self):
+        '''Every plot, split up as stencil.manifest does, with its output
+           pinned down so failures can be matched back to it
+        '''
+        plots = []
+        for job in self.plot_jobs:
+            for plot in jobs.expand(job, self.session):
+                plot = dict(plot, inputs = [dict(x) for x in plot["inputs"]])
+                for inp in plot["inputs"]:
+                    if inp.get("objname") is None:
+                        inp["objname"] = self.session.get_keys(inp["filename"])[0]
+                plot["outfile"] = os.path.abspath(expected_outfile(plot))
+                plots.append(plot)
+        return plots
+
+    def fingerprints(self, plots, changed):
+        '''Fingerprint of each (file, key) the plots use, read again only for
+           files in changed. Returns them and the (file, key) pairs that
+           couldn't be read (missing, or in a half written file) with the
+           reason. Each object is let go once it's hashed
+        '''
+        found = {}
+        unreadable = {}
+        for plot in plots:
+            for inp in plot["inputs"]:
+                filename, key = inp["filename"], inp["objname"]
+                known = self.state["keys"].get(filename, {})
+                if (filename, key) in found or (filename, key) in unreadable:
+                    continue
+                if filename not in changed and key in known:
+                    found[(filename, key)] = known[key]
+                    continue
+                try:
+                    ob = self.session.grab_obj(filename, key)
+                    if not ob:
+                        raise KeyError("no {0} in {1}".format(key, filename))
+                    found[(filename, key)] = cache.fingerprint(ob)
+                except Exception as err:
+                    unreadable[(filename, key)] = repr(err)
+                finally:
+                    # free the histogram now, not when the next key is read
+                    ob = None
+        return found, unreadable
+
+    def update(self):
+        '''One pass: redraw whatever is out of date. Returns the outputs drawn
+           and (what, error) for anything that failed
+        '''
+        stamps  = dict((x, rio.file_stamp(x)) for x in self.input_files())
+        changed = set(x for x, stamp in stamps.iteritems()
+                      if stamp != self.state["files"].get(x))
+        if not changed and not self.retry:
+            return [], []
+        for filename in changed:
+            self.session.forget(filename)
+
+        plots = self.plan()
+        found, unreadable = self.fingerprints(plots, changed)
+        failures = [("{0}:{1}".format(*x), "unreadable: " + err)
+                    for x, err in sorted(unreadable.iteritems())]
+        bad_files = set(x[0] for x in unreadable)
+
+        redraw = self.changed_outputs(found)
+        stale = []
+        for plot in plots:
+            if any((x["filename"], x["objname"]) in unreadable for x in plot["inputs"]):
+                continue
+            inputs = [[x["filename"], x["objname"], found[(x["filename"], x["objname"])]]
+                      for x in plot["inputs"]]
+            recorded = self.state["outputs"].get(plot["outfile"])
+            # besides changed objects: new plots, plots given other inputs
+            # in the manifest and outputs that have gone
+            if (plot["outfile"] in redraw or recorded is None or
+                [x[:2] for x in recorded] != [x[:2] for x in inputs] or
+                not os.path.exists(plot["outfile"])):
+                stale.append((plot, inputs))
+
+        if stale:
+            failures += manifest.run([x[0] for x in stale], self.n_jobs,
+                                     self.compiler, self.session)
+        failed = set(os.path.abspath(x[0]) for x in failures)
+
+        drawn = []
+        for plot, inputs in stale:
+            outfile = plot["outfile"]
+            if outfile in failed or os.path.splitext(outfile)[0] + ".pdf" in failed:
+                continue
+            self.state["outputs"][outfile] = inputs
+            drawn.append(outfile)
+        for (filename, key), fprint in found.iteritems():
+            self.state["keys"].setdefault(filename, {})[key] = fprint
+        for filename, stamp in stamps.iteritems():
+            # so files with a key we couldn't read are looked at again
+            if filename not in bad_files:
+                self.state["files"][filename] = stamp
+        save_state(self.state, self.state_file)
+
+        self.retry = bool(failures)
+        return drawn, failures
+
+    def watch(self, interval = 5., stream = sys.stderr):
+        '''Keep updating every interval seconds, until interrupted
+        '''
+        while True:
+            drawn, failures = self.update()
+            for outfile in drawn:
+                stream.write("drew {0}\n".format(outfile))
+            for item, err in failures:
+                stream.write("Failed on {0}:\n{1}\n".format(item, err))
+            time.sleep(interval)